@@ -23,7 +23,8 @@ Provides functionality for cleaning up old ZFS snapshots
 """
 
 import re
-from datetime import datetime
+from bisect import bisect_left
+from datetime import date, datetime
 
 from zfs import ZFS
 
@@ -34,94 +35,124 @@ class Cleaner(object):
     """
 
     logger = None  # The manager will fill this object
+    schemas = {}  # Compiled bucket boundaries per schema
+    ordinals = {}  # Parsed day ordinal per snapshot name following the naming convention. Other names aren't kept, as
+                   # they're unbounded (e.g. the snapshots of other tools), while dated names repeat across datasets.
+    schema_pattern = re.compile('^(?P<days>[0-9]+)d(?P<weeks>[0-9]+)w(?P<months>[0-9]+)m(?P<years>[0-9]+)y$')
+    name_pattern = re.compile('^(\d{4})(1[0-2]|0[1-9])(0[1-9]|[1-2]\d|3[0-1])$')
 
     @staticmethod
-    def clean(dataset, snapshots, schema, recursive):
-        today = datetime.now()
-
-        # Parsing schema
-        match = re.match('^(?P<days>[0-9]+)d(?P<weeks>[0-9]+)w(?P<months>[0-9]+)m(?P<years>[0-9]+)y$', schema)
-        if not match:
+    def clean(dataset, snapshots, schema, recursive, held_snapshots=None):
+        """
+        Destroys the snapshots of a dataset that fall outside of the schema. Without given holds, they are only
+        retreived when there is something to destroy.
+        """
+
+        now = datetime.now()
+        try:
+            _, delete, held = Cleaner.plan(snapshots, schema, now, held_snapshots or frozenset())
+            if delete and held_snapshots is None:
+                held_snapshots = ZFS.get_held_snapshots([dataset])[dataset]
+                _, delete, held = Cleaner.plan(snapshots, schema, now, held_snapshots)
+        except ValueError:
             Cleaner.logger.info('Got invalid schema for dataset {0}: {1}'.format(dataset, schema))
             return
-        matchinfo = match.groupdict()
-        settings = {}
-        for key in matchinfo.keys():
-            settings[key] = int(matchinfo[key])
-
-        # Loading snapshots
-        snapshot_dict = []
-        held_snapshots = []
+
+        if delete:
+            Cleaner.logger.info('Cleaning {0}'.format(dataset))
+            for snapshot in held:
+                Cleaner.logger.info('  Skipping held {0}@{1}'.format(dataset, snapshot))
+            for snapshot in delete:
+                Cleaner.logger.info('  Destroying {0}@{1}'.format(dataset, snapshot))
+            ZFS.destroy_many(dataset, delete, recursive)
+            Cleaner.logger.info('Cleaning {0} complete'.format(dataset))
+
+    @staticmethod
+    def plan(snapshots, schema, today, held_snapshots=frozenset()):
+        """
+        Calculates which snapshots to keep and which to delete, without touching ZFS. Returns the lists of kept,
+        to be deleted and held snapshots. Snapshots not following the naming convention are never touched.
+        """
+
+        boundaries = Cleaner.compile_schema(schema)
+        today = today.toordinal()
+
+        held = []
+        oldest = {}  # The oldest snapshot per bucket
+        delete = {}  # The snapshots to delete per bucket
+        end_of_life = []
         for snapshot in snapshots:
-            if re.match('^(\d{4})(1[0-2]|0[1-9])(0[1-9]|[1-2]\d|3[0-1])$', snapshot) is not None:
-                if ZFS.is_held(dataset, snapshot):
-                    held_snapshots.append(snapshot)
-                    continue
-                snapshot_dict.append({'name': snapshot,
-                                      'time': datetime.strptime(snapshot, '%Y%m%d'),
-                                      'age': (today - datetime.strptime(snapshot, '%Y%m%d')).days})
-
-        buckets = {}
+            ordinal = Cleaner.ordinals.get(snapshot)
+            if ordinal is None:
+                ordinal = Cleaner.parse_name(snapshot)
+            if ordinal is None:
+                continue
+            if snapshot in held_snapshots:
+                held.append(snapshot)
+                continue
+            age = today - ordinal
+            index = bisect_left(boundaries, age)
+            if index == len(boundaries):
+                end_of_life.append(snapshot)
+                continue
+            current = oldest.get(index)
+            if current is None:
+                oldest[index] = (age, snapshot)
+            elif age > current[0]:
+                oldest[index] = (age, snapshot)
+                delete.setdefault(index, []).append(current[1])
+            else:
+                delete.setdefault(index, []).append(snapshot)
+
+        keep = [oldest[index][1] for index in sorted(oldest)]
+        to_delete = []
+        for index in sorted(delete):
+            to_delete.extend(delete[index])
+        to_delete.extend(end_of_life)
+        return keep, to_delete, held
+
+    @staticmethod
+    def compile_schema(schema):
+        """
+        Converts a schema into the sorted list of bucket boundaries (the maximum age in days of each bucket)
+        """
+
+        boundaries = Cleaner.schemas.get(schema)
+        if boundaries is not None:
+            return boundaries
+        match = Cleaner.schema_pattern.match(schema)
+        if not match:
+            raise ValueError('Invalid schema: {0}'.format(schema))
+        settings = dict((key, int(value)) for key, value in match.groupdict().items())
+        boundaries = []
         counter = -1
-        for i in range(settings['days']):
+        for _ in range(settings['days']):
             counter += 1
-            buckets[counter] = []
-        for i in range(settings['weeks']):
+            boundaries.append(counter)
+        for _ in range(settings['weeks']):
             counter += 7
-            buckets[counter] = []
-        for i in range(settings['months']):
+            boundaries.append(counter)
+        for _ in range(settings['months']):
             counter += 28
-            buckets[counter] = []
-        for i in range(settings['years']):
+            boundaries.append(counter)
+        for _ in range(settings['years']):
             counter += (28 * 12)
-            buckets[counter] = []
-
-        will_delete = False
-
-        end_of_life_snapshots = []
-        for snapshot in snapshot_dict:
-            possible_keys = []
-            for key in buckets:
-                if snapshot['age'] <= key:
-                    possible_keys.append(key)
-            if possible_keys:
-                buckets[min(possible_keys)].append(snapshot)
-            else:
-                will_delete = True
-                end_of_life_snapshots.append(snapshot)
-
-        to_delete = {}
-        to_keep = {}
-        for key in buckets:
-            oldest = None
-            if len(buckets[key]) == 1:
-                oldest = buckets[key][0]
-            else:
-                for snapshot in buckets[key]:
-                    if oldest is None:
-                        oldest = snapshot
-                    elif snapshot['age'] > oldest['age']:
-                        oldest = snapshot
-                    else:
-                        will_delete = True
-                        to_delete[key] = to_delete.get(key, []) + [snapshot]
-            to_keep[key] = oldest
-            to_delete[key] = to_delete.get(key, [])
-
-        if will_delete is True:
-            Cleaner.logger.info('Cleaning {0}'.format(dataset))
-            for snapshot in held_snapshots:
-                Cleaner.logger.info('  Skipping held {0}@{1}'.format(dataset, snapshot))
+            boundaries.append(counter)
+        Cleaner.schemas[schema] = boundaries
+        return boundaries
 
-        keys = to_delete.keys()
-        keys.sort()
-        for key in keys:
-            for snapshot in to_delete[key]:
-                Cleaner.logger.info('  Destroying {0}@{1}'.format(dataset, snapshot['name']))
-                ZFS.destroy(dataset, snapshot['name'], recursive)
-        for snapshot in end_of_life_snapshots:
-            Cleaner.logger.info('  Destroying {0}@{1}'.format(dataset, snapshot['name']))
-            ZFS.destroy(dataset, snapshot['name'], recursive)
-
-        if will_delete is True:
-            Cleaner.logger.info('Cleaning {0} complete'.format(dataset))
+    @staticmethod
+    def parse_name(snapshot):
+        """
+        Returns the day ordinal of a snapshot following the yyyymmdd naming convention, None otherwise. Only the
+        ordinals of matching names are memoized.
+        """
+
+        if Cleaner.name_pattern.match(snapshot) is None:
+            return None
+        try:
+            ordinal = date(int(snapshot[0:4]), int(snapshot[4:6]), int(snapshot[6:8])).toordinal()
+        except ValueError:  # E.g. 20150230
+            return None
+        Cleaner.ordinals[snapshot] = ordinal
+        return ordinal
@@ -0,0 +1,118 @@
+# Copyright (c) 2014 Kenneth Henderick <kenneth@ketronic.be>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Provides functionality for choosing the compression of replication streams per endpoint
+"""
+
+import os
+import threading
+import time
+
+from helper import Helper, SSH
+
+
+class Compression(object):
+    """
+    Chooses the compression program that gives the highest effective transfer rate towards an endpoint. The rate
+    (uncompressed bytes per second) of every candidate is measured on actual transfers, so it reflects both the
+    link throughput and the compression ratio and speed.
+    """
+
+    logger = None  # The manager will fill this object
+    candidates = [None, 'lz4', 'zstd -1', 'zstd -6', 'gzip']  # Compression programs to choose from, None is no compression
+    interval = 86400  # Seconds after which the candidates of an endpoint are re-evaluated
+    minimum_size = 64 * 1024 * 1024  # Transfers smaller than this are dominated by latency and don't count as a measurement
+    maximum_probe_size = 1024 * 1024 * 1024  # Larger transfers always use the best known candidate instead of trying one
+    weight = 0.5  # Weight of a new measurement against the previous rate of a candidate
+    lock = threading.Lock()
+    endpoints = {}  # State per endpoint: the available candidates, their rates, the ones measured since the last
+                    # re-evaluation and when that started
+
+    @staticmethod
+    def choose(endpoint, size):
+        """
+        Returns the compression program to use for a transfer of the given size (in bytes) towards an endpoint.
+        Candidates that weren't measured since the last re-evaluation are tried first, as long as the transfer is large
+        enough to measure and small enough to not risk much time on a slow candidate.
+        """
+
+        if endpoint == '':
+            return None  # Local transfers are never compressed
+        state = Compression.get_state(endpoint)
+        with Compression.lock:
+            rates = dict((candidate, rate) for candidate, rate in state['rates'].items() if candidate in state['available'])
+            if Compression.minimum_size <= size <= Compression.maximum_probe_size:
+                for candidate in state['available']:
+                    if candidate not in state['measured']:
+                        return candidate
+            if not rates:
+                return None
+            return max(rates, key=lambda candidate: rates[candidate])
+
+    @staticmethod
+    def record(endpoint, compression, size, duration):
+        """
+        Registers the outcome of a transfer that used the given compression
+        """
+
+        if endpoint == '' or size < Compression.minimum_size or duration <= 0:
+            return
+        state = Compression.get_state(endpoint)
+        rate = size / duration
+        with Compression.lock:
+            if compression in state['rates']:
+                rate = Compression.weight * rate + (1 - Compression.weight) * state['rates'][compression]
+            state['rates'][compression] = rate
+            state['measured'].add(compression)
+        Compression.logger.info('  Compression {0} towards {1}: {2:.1f} MiB/s effective'.format(
+            compression or 'none', endpoint, rate / 1024 / 1024))
+
+    @staticmethod
+    def get_state(endpoint):
+        """
+        Returns the state of an endpoint, (re)starting the measurements when needed. The known rates are kept on a
+        re-evaluation, so the best candidate remains in use until the others are measured again.
+        """
+
+        with Compression.lock:
+            state = Compression.endpoints.get(endpoint)
+            if state is not None and time.time() - state['since'] < Compression.interval:
+                return state
+        available = Compression.get_available(endpoint)
+        with Compression.lock:
+            rates = Compression.endpoints[endpoint]['rates'] if endpoint in Compression.endpoints else {}
+            state = {'since': time.time(), 'rates': rates, 'measured': set(), 'available': available}
+            Compression.endpoints[endpoint] = state
+            return state
+
+    @staticmethod
+    def get_available(endpoint):
+        """
+        Returns the candidates of which the program is installed on both sides
+        """
+
+        programs = sorted(set(candidate.split(' ')[0] for candidate in Compression.candidates if candidate is not None))
+        # dash's command -v only reports the first of multiple names
+        command = 'for program in {0}; do command -v $program; done; true'.format(' '.join(programs))
+        local = set(os.path.basename(path) for path in Helper.run_command(command, '/').split())
+        remote = set(os.path.basename(path) for path in Helper.run_command('{0} \'{1}\''.format(SSH.wrap(endpoint), command), '/').split())
+        return [candidate for candidate in Compression.candidates
+                if candidate is None or (candidate.split(' ')[0] in local and candidate.split(' ')[0] in remote)]
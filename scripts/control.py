@@ -0,0 +1,211 @@
+#!/usr/bin/python2
+# Copyright (c) 2014 Kenneth Henderick <kenneth@ketronic.be>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Provides a control socket to query and steer the running daemon, and the command line client using it
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from datetime import timedelta
+
+from helper import Helper
+
+
+SOCKET_FILENAME = '/var/run/zfs-snap-manager/control.sock'
+
+
+class Control(object):
+    """
+    Serves requests on a Unix socket, one JSON request and one JSON response per connection. The requests are
+    answered by a handler from the daemon's state.
+    """
+
+    logger = None  # The manager will fill this object
+    timeout = 10  # Seconds a client gets to send its request
+
+    @staticmethod
+    def start(filename, handler):
+        """
+        Starts serving the socket in a background thread. An empty filename disables the socket.
+        """
+
+        if filename == '':
+            return
+        directory = os.path.dirname(filename)
+        if directory != '' and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        if os.path.exists(filename):
+            os.remove(filename)  # Left behind by a previous instance
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(filename)
+        os.chmod(filename, 0o600)
+        server.listen(5)
+        thread = threading.Thread(target=Control.serve, args=(server, handler), name='control')
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def serve(server, handler):
+        """
+        Accepts connections, forever
+        """
+
+        while True:
+            connection, _ = server.accept()
+            try:
+                connection.settimeout(Control.timeout)
+                request = Control.receive(connection)
+                try:
+                    response = handler(request)
+                except Exception as ex:
+                    response = {'error': str(ex)}
+                connection.sendall(json.dumps(response) + '\n')
+            except Exception as ex:
+                Control.logger.error('Exception while serving the control socket: {0}'.format(str(ex)))
+            finally:
+                connection.close()
+
+    @staticmethod
+    def receive(connection):
+        """
+        Reads a single JSON message, terminated by a newline
+        """
+
+        data = ''
+        while not data.endswith('\n'):
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return json.loads(data)
+
+    @staticmethod
+    def request(filename, request):
+        """
+        Sends a request to the daemon, returning its response
+        """
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(filename)
+            client.sendall(json.dumps(request) + '\n')
+            return Control.receive(client)
+        finally:
+            client.close()
+
+
+class Client(object):
+    """
+    Shows the responses of the daemon in a readable form
+    """
+
+    @staticmethod
+    def show_status(response):
+        """
+        Shows the replication queue of the current (or last) run, the transfers in flight and the deferred replications
+        """
+
+        now = time.time()
+        print 'Queue:'
+        for job in response['queue']:
+            print '  {0:<40} {1:<10} {2}'.format(job['dataset'], job['status'], Helper.format_size(job['size']))
+        if not response['queue']:
+            print '  (empty)'
+        print 'Transfers:'
+        for transfer in response['transfers']:
+            eta = ', ETA {0}'.format(timedelta(seconds=int(transfer['eta']))) if transfer['eta'] is not None else ''
+            print '  {0}@{1} > {2}: {3}, running for {4}{5}'.format(
+                transfer['dataset'], transfer['snapshot'], transfer['target'], Helper.format_size(transfer['size']),
+                timedelta(seconds=int(now - transfer['started'])), eta)
+        if not response['transfers']:
+            print '  (none)'
+        if response['deferred']:
+            print 'Deferred:'
+            for dataset, since in sorted(response['deferred'].items()):
+                print '  {0:<40} waiting for {1}'.format(dataset, timedelta(seconds=int(now - since)))
+
+    @staticmethod
+    def show_inventory(response, dataset=None):
+        """
+        Shows the snapshots of a single dataset, or a summary of all datasets
+        """
+
+        if dataset is not None:
+            for snapshot in response['snapshots']:
+                print snapshot
+            return
+        for dataset, summary in sorted(response['inventory'].items()):
+            if summary['count'] > 0:
+                print '{0:<40} {1:>6} snapshots, {2} - {3}'.format(dataset, summary['count'], summary['oldest'], summary['newest'])
+            else:
+                print '{0:<40} {1:>6} snapshots'.format(dataset, 0)
+
+    @staticmethod
+    def show_lag(response):
+        """
+        Shows the replication lag per target
+        """
+
+        for entry in sorted(response['lag'], key=lambda entry: (entry['dataset'], entry['target'])):
+            print '{0:<40} {1:<40} {2:>4} snapshots, {3}'.format(entry['dataset'], entry['target'], int(entry['snapshots']),
+                                                                  Helper.format_size(entry['bytes']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Queries and steers the running zfs-snap-manager daemon')
+    parser.add_argument('--socket', default=SOCKET_FILENAME, help='Control socket of the daemon')
+    parser.add_argument('--json', action='store_true', help='Show the raw response')
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='Handles a section now, as if it were due')
+    run_parser.add_argument('dataset')
+    commands.add_parser('status', help='Shows the replication queue, the transfers in flight and the deferred replications')
+    inventory_parser = commands.add_parser('inventory', help='Shows the cached datasets and snapshots')
+    inventory_parser.add_argument('dataset', nargs='?')
+    commands.add_parser('lag', help='Shows the replication lag per target')
+    arguments = parser.parse_args()
+
+    request = {'command': arguments.command}
+    if getattr(arguments, 'dataset', None) is not None:
+        request['dataset'] = arguments.dataset
+    try:
+        response = Control.request(arguments.socket, request)
+    except socket.error as ex:
+        sys.stderr.write('Could not connect to {0}: {1}\n'.format(arguments.socket, str(ex)))
+        sys.exit(1)
+    if 'error' in response:
+        sys.stderr.write('{0}\n'.format(response['error']))
+        sys.exit(1)
+    if arguments.json is True:
+        print json.dumps(response, indent=4, sort_keys=True)
+    elif arguments.command == 'run':
+        print response['result']
+    elif arguments.command == 'status':
+        Client.show_status(response)
+    elif arguments.command == 'inventory':
+        Client.show_inventory(response, request.get('dataset'))
+    elif arguments.command == 'lag':
+        Client.show_lag(response)
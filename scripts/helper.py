@@ -22,25 +22,260 @@
 Provides basic helper functionality
 """
 
+import os
 import re
+import signal
+import tempfile
+import threading
+import time
 from subprocess import Popen, PIPE
 
+from metrics import Metrics
+
+
+MAX_ARGUMENT_LENGTH = 65536  # Keeps generated command lines well below the kernel's argument limits
+STREAM_BUFFER_SIZE = 65536  # Pipe read buffer of streamed commands
+SCRUBBED_CHARACTERS = ''.join(chr(i) for i in range(256) if re.match(r'[\n\t@# a-zA-Z0-9_\\.:/\-]', chr(i)) is None)
+
 
 class Helper(object):
     """
     Contains generic helper functionality
     """
 
+    timeout = 1800  # Seconds after which a command is killed, 0 for no limit
+    stream_timeout = 0  # Seconds after which a replication stream is killed, 0 for no limit
+    stall_timeout = 600  # Seconds without any I/O after which a replication stream is killed, 0 for no limit
+    hook_timeout = 0  # Seconds after which a preexec or postexec command is killed, 0 for no limit
+
     @staticmethod
-    def run_command(command, cwd):
+    def run_command(command, cwd, stream=False, timeout=None):
         """
         Executes a command, returning the output. If the command fails, it raises
+        A stream (e.g. a send/receive pipeline) gets the stream timeout instead of the regular timeout, and is killed
+        when it stalls. A given timeout replaces the regular one.
         """
 
-        pattern = re.compile(r'[^\n\t@ a-zA-Z0-9_\\.:/\-]+')
-        process = Popen(command, shell=True, cwd=cwd, stdout=PIPE, stderr=PIPE)
-        out, err = process.communicate()
+        start = time.time()
+        process = Popen(command, shell=True, cwd=cwd, stdout=PIPE, stderr=PIPE, preexec_fn=os.setsid)
+        if stream is True:
+            Watchdog.watch(process, Helper.stream_timeout, Helper.stall_timeout)
+        else:
+            Watchdog.watch(process, Helper.timeout if timeout is None else timeout)
+        try:
+            out, err = process.communicate()
+        finally:
+            reason = Watchdog.unwatch(process)
         return_code = process.poll()
+        Metrics.record_command(command, time.time() - start, reason or return_code)
+        if reason is not None:
+            raise RuntimeError('{0} was killed because it {1}'.format(command, Watchdog.REASONS[reason]))
         if return_code != 0:
             raise RuntimeError('{0} failed with return value {1} and error message {2}'.format(command, return_code, err))
-        return re.sub(pattern, '', out)
+        return out.translate(None, SCRUBBED_CHARACTERS)
+
+    @staticmethod
+    def run_command_lines(command, cwd):
+        """
+        Executes a command, yielding its output line by line as it is produced. If the command fails, it raises
+        once all output is consumed. Error output is spooled to a temporary file so it can't block the command.
+        """
+
+        start = time.time()
+        errors = tempfile.TemporaryFile()
+        process = Popen(command, shell=True, cwd=cwd, stdout=PIPE, stderr=errors, bufsize=STREAM_BUFFER_SIZE, preexec_fn=os.setsid)
+        Watchdog.watch(process, Helper.timeout)
+        try:
+            for line in iter(process.stdout.readline, ''):
+                yield line.rstrip('\n').translate(None, SCRUBBED_CHARACTERS)
+            process.stdout.close()
+            return_code = process.wait()
+            reason = Watchdog.unwatch(process)
+            Metrics.record_command(command, time.time() - start, reason or return_code)
+            if reason is not None:
+                raise RuntimeError('{0} was killed because it {1}'.format(command, Watchdog.REASONS[reason]))
+            if return_code != 0:
+                errors.seek(0)
+                raise RuntimeError('{0} failed with return value {1} and error message {2}'.format(command, return_code, errors.read()))
+        finally:
+            Watchdog.unwatch(process)
+            if process.poll() is None:
+                # The consumer stopped early
+                Watchdog.kill(process.pid, signal.SIGKILL)
+                process.wait()
+            errors.close()
+
+    @staticmethod
+    def format_size(size):
+        """
+        Converts a number of bytes into a human readable size (e.g. 1.50GiB)
+        """
+
+        for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB']:
+            if size < 1024 or unit == 'PiB':
+                break
+            size /= 1024.0
+        if unit == 'B':
+            return '{0}B'.format(int(size))
+        return '{0:.2f}{1}'.format(size, unit)
+
+    @staticmethod
+    def chunk(arguments, max_length=MAX_ARGUMENT_LENGTH):
+        """
+        Splits a list of arguments in chunks of which the joined length stays below the given length
+        """
+
+        chunks = []
+        current = []
+        length = 0
+        for argument in arguments:
+            if current and length + len(argument) + 1 > max_length:
+                chunks.append(current)
+                current = []
+                length = 0
+            current.append(argument)
+            length += len(argument) + 1
+        if current:
+            chunks.append(current)
+        return chunks
+
+
+class Watchdog(object):
+    """
+    Watches the running commands from a background thread. The process group of a command (the shell and everything
+    it started) is terminated when the command exceeds its timeout, or when it is a stream of which none of the
+    processes did any I/O for a while (e.g. an mbuffer waiting for a peer that went away).
+    """
+
+    REASONS = {'timeout': 'timed out', 'stalled': 'stalled'}
+    interval = 5  # Seconds between two checks
+    grace = 10  # Seconds between terminating and killing a process group
+    lock = threading.Lock()
+    processes = {}  # State of the watched commands, per process group
+    thread = None
+
+    @staticmethod
+    def watch(process, timeout, stall_timeout=0):
+        """
+        Starts watching a command, which must run in its own process group
+        """
+
+        now = time.time()
+        with Watchdog.lock:
+            Watchdog.processes[process.pid] = {'deadline': now + timeout if timeout > 0 else None,
+                                               'stall_timeout': stall_timeout,
+                                               'io': None,
+                                               'progress': now,
+                                               'reason': None,
+                                               'terminated': None}
+            if Watchdog.thread is None:
+                Watchdog.thread = threading.Thread(target=Watchdog.run, name='watchdog')
+                Watchdog.thread.daemon = True
+                Watchdog.thread.start()
+
+    @staticmethod
+    def unwatch(process):
+        """
+        Stops watching a command, returning the reason it was killed for, if it was
+        """
+
+        with Watchdog.lock:
+            state = Watchdog.processes.pop(process.pid, None)
+        if state is None:
+            return None
+        return state['reason']
+
+    @staticmethod
+    def run():
+        """
+        Checks the watched commands, forever
+        """
+
+        while True:
+            time.sleep(Watchdog.interval)
+            with Watchdog.lock:
+                processes = Watchdog.processes.items()
+            for pgid, state in processes:
+                now = time.time()
+                if state['terminated'] is not None:
+                    if now - state['terminated'] > Watchdog.grace:
+                        Watchdog.kill(pgid, signal.SIGKILL)
+                    continue
+                if state['deadline'] is not None and now > state['deadline']:
+                    state['reason'] = 'timeout'
+                elif state['stall_timeout'] > 0:
+                    io = Watchdog.get_io(pgid)
+                    if io != state['io']:
+                        state['io'] = io
+                        state['progress'] = now
+                    elif io is not None and now - state['progress'] > state['stall_timeout']:
+                        state['reason'] = 'stalled'
+                if state['reason'] is not None:
+                    state['terminated'] = now
+                    Watchdog.kill(pgid, signal.SIGTERM)
+
+    @staticmethod
+    def kill(pgid, signal_number):
+        """
+        Sends a signal to all processes of a process group
+        """
+
+        try:
+            os.killpg(pgid, signal_number)
+        except OSError:
+            pass  # The processes ended in the meantime
+
+    @staticmethod
+    def get_io(pgid):
+        """
+        Returns the number of bytes read and written by all processes of a process group, or None when it can't be
+        determined (e.g. without /proc)
+        """
+
+        total = 0
+        found = False
+        try:
+            pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
+        except OSError:
+            return None
+        for pid in pids:
+            try:
+                with open('/proc/{0}/stat'.format(pid)) as stat_file:
+                    # The process name is between parentheses and might contain spaces
+                    fields = stat_file.read().rsplit(')', 1)[1].split()
+                if int(fields[2]) != pgid:
+                    continue
+                with open('/proc/{0}/io'.format(pid)) as io_file:
+                    for line in io_file:
+                        key, _, value = line.partition(':')
+                        if key in ('rchar', 'wchar'):
+                            total += int(value)
+                found = True
+            except (IOError, OSError, IndexError, ValueError):
+                continue  # The process ended in the meantime
+        return total if found else None
+
+
+class SSH(object):
+    """
+    Reuses a single multiplexed ssh connection per endpoint for all remote commands
+    """
+
+    control_directory = '/var/run/zfs-snap-manager'
+    persist = 600  # Seconds an idle master connection is kept open, 0 disables connection sharing
+    lock = threading.Lock()
+
+    @staticmethod
+    def wrap(endpoint):
+        """
+        Adds the connection sharing options to an ssh endpoint. Other endpoints are returned as is.
+        """
+
+        parts = endpoint.split(' ', 1)
+        if SSH.persist <= 0 or os.path.basename(parts[0]) != 'ssh':
+            return endpoint
+        with SSH.lock:
+            if not os.path.isdir(SSH.control_directory):
+                os.makedirs(SSH.control_directory, 0o700)
+        options = '-o ControlMaster=auto -o ControlPath={0}/ssh-%C -o ControlPersist={1}'.format(SSH.control_directory, SSH.persist)
+        return ' '.join([parts[0], options] + parts[1:])
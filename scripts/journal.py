@@ -0,0 +1,131 @@
+# Copyright (c) 2014 Kenneth Henderick <kenneth@ketronic.be>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Provides a persistent journal of the replication state
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+
+class Journal(object):
+    """
+    Keeps track of the last snapshot replicated to (and held on) every target and of the transfers in flight, in a
+    small SQLite database. It allows skipping the listing of replication targets, also after a restart.
+    """
+
+    lock = threading.Lock()
+    connection = None  # None when the journal is disabled
+
+    @staticmethod
+    def open(filename):
+        """
+        Opens (and if needed creates) the journal. An empty filename disables the journal.
+        """
+
+        with Journal.lock:
+            if Journal.connection is not None:
+                Journal.connection.close()
+                Journal.connection = None
+            if filename == '':
+                return
+            directory = os.path.dirname(filename)
+            if directory != '' and not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            connection = sqlite3.connect(filename, check_same_thread=False)
+            connection.execute('CREATE TABLE IF NOT EXISTS replicas (dataset TEXT, target TEXT, snapshot TEXT, held TEXT, '
+                               'updated REAL, PRIMARY KEY (dataset, target))')
+            connection.execute('CREATE TABLE IF NOT EXISTS transfers (dataset TEXT, target TEXT, base TEXT, snapshot TEXT, '
+                               'started REAL, PRIMARY KEY (dataset, target))')
+            connection.commit()
+            Journal.connection = connection
+
+    @staticmethod
+    def execute(query, parameters=()):
+        """
+        Executes a query, returning all resulting rows. Returns nothing when the journal is disabled.
+        """
+
+        with Journal.lock:
+            if Journal.connection is None:
+                return []
+            rows = Journal.connection.execute(query, parameters).fetchall()
+            Journal.connection.commit()
+            return rows
+
+    @staticmethod
+    def get_replicated(dataset, target):
+        """
+        Returns the last snapshot that was replicated to a target and is held on both sides, if it's known and no
+        transfer towards the target is in flight
+        """
+
+        rows = Journal.execute('SELECT replicas.snapshot, replicas.held FROM replicas LEFT JOIN transfers '
+                               'ON replicas.dataset = transfers.dataset AND replicas.target = transfers.target '
+                               'WHERE replicas.dataset = ? AND replicas.target = ? AND transfers.dataset IS NULL', (dataset, target))
+        if not rows or rows[0][0] != rows[0][1]:
+            return None
+        return rows[0][0]
+
+    @staticmethod
+    def start_transfer(dataset, target, base_snapshot, snapshot):
+        """
+        Registers a transfer that is about to start
+        """
+
+        Journal.execute('INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?)', (dataset, target, base_snapshot, snapshot, time.time()))
+
+    @staticmethod
+    def finish_transfer(dataset, target, snapshot):
+        """
+        Registers a completed transfer
+        """
+
+        Journal.execute('INSERT OR REPLACE INTO replicas VALUES (?, ?, ?, (SELECT held FROM replicas WHERE dataset = ? AND target = ?), ?)',
+                        (dataset, target, snapshot, dataset, target, time.time()))
+        Journal.execute('DELETE FROM transfers WHERE dataset = ? AND target = ?', (dataset, target))
+
+    @staticmethod
+    def record_hold(dataset, target, snapshot):
+        """
+        Registers the snapshot that holds the replication towards a target, on both sides
+        """
+
+        Journal.execute('UPDATE replicas SET held = ?, updated = ? WHERE dataset = ? AND target = ?', (snapshot, time.time(), dataset, target))
+
+    @staticmethod
+    def forget(dataset, target):
+        """
+        Drops everything known about a target, so its state is retrieved from ZFS again
+        """
+
+        Journal.execute('DELETE FROM replicas WHERE dataset = ? AND target = ?', (dataset, target))
+        Journal.execute('DELETE FROM transfers WHERE dataset = ? AND target = ?', (dataset, target))
+
+    @staticmethod
+    def get_transfers():
+        """
+        Returns the transfers in flight, as (dataset, target, base snapshot, snapshot, start time)
+        """
+
+        return Journal.execute('SELECT dataset, target, base, snapshot, started FROM transfers ORDER BY started')
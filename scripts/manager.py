@@ -26,16 +26,29 @@ Provides the overal functionality
 import ConfigParser
 import time
 import os
+import re
 import logging
 import logging.handlers
+import threading
 from datetime import datetime,timedelta
+from multiprocessing.pool import ThreadPool
 
-from zfs import ZFS
+from zfs import ZFS, Inventory
 from clean import Cleaner
-from helper import Helper
+from helper import Helper, SSH
+from scheduler import Scheduler
+from metrics import Metrics
+from compression import Compression
+from journal import Journal
+from control import Control
 
 
 BUFFER_SIZE = '512M' # Default -m value to pass to mbuffer
+GLOBAL_SECTION = 'zfs-snap-manager'  # Configuration section holding the daemon-wide settings
+SEND_FLAGS = [('send_compressed', '-c'),  # Per section options enabling native zfs send flags
+              ('send_large_blocks', '-L'),
+              ('send_embedded', '-e'),
+              ('send_raw', '-w')]
 
 
 class Manager(object):
@@ -44,6 +57,12 @@ class Manager(object):
     """
 
     logger = None  # To be overwritten by Manager.init_logger()
+    semaphores = {}  # Concurrency limits per endpoint and per pool
+    semaphores_lock = threading.Lock()
+    deferred = {}  # Replications deferred until their window opens, with the time since which they're waiting
+    requested = set()  # Datasets to handle on the next run, as requested over the control socket
+    queue = []  # The replications of the current (or last) run, with their status
+    transfers = {}  # The transfers in flight, per target
 
     @staticmethod
     def init_logger():
@@ -61,181 +80,869 @@ class Manager(object):
         Manager.logger.addHandler(handler)
         Cleaner.logger = Manager.logger  # Pass logger along
         ZFS.logger = Manager.logger  # Pass logger along
+        Scheduler.logger = Manager.logger  # Pass logger along
+        Compression.logger = Manager.logger  # Pass logger along
+        Control.logger = Manager.logger  # Pass logger along
 
     @staticmethod
-    def run(settings):
+    def get_semaphore(kind, key, limit):
         """
-        Executes a single run where certain datasets might or might not be snapshotted
+        Returns the semaphore limiting the concurrency for a given endpoint or pool, creating it if needed
+        """
+
+        with Manager.semaphores_lock:
+            if (kind, key) not in Manager.semaphores:
+                Manager.semaphores[(kind, key)] = threading.BoundedSemaphore(limit) if limit > 0 else None
+            return Manager.semaphores[(kind, key)]
+
+    @staticmethod
+    def run(settings, global_settings):
+        """
+        Executes a single run where certain datasets might or might not be snapshotted. The replications of the run
+        are queued by priority and estimated size, after all snapshots are taken. Every dataset is finished (post
+        execution and cleaning) as soon as its own replication is done.
         """
 
         now = datetime.now()
-        yda = datetime.now() - timedelta(1)
+        start = time.time()
+        commands = Metrics.commands
+
+        datasets, snapshots = Inventory.load(settings.keys())
+        due = dict((dataset, Manager.is_due(dataset, settings[dataset], snapshots.get(dataset, []), now)) for dataset in datasets)
+        # Deferred replications are retried once their window is open, without running the other phases again
+        retry = [dataset for dataset in datasets if due[dataset] is False and dataset in Manager.deferred and
+                 Scheduler.is_open(settings[dataset]['window'], now)]
+        replicating = [dataset for dataset in datasets if due[dataset] is True or dataset in retry]
+        # The holds of the other datasets are only retreived when cleaning would destroy something
+        held_snapshots = ZFS.get_held_snapshots([dataset for dataset in replicating if settings[dataset]['replicate'] is not None])
+        remote_snapshots = Manager.get_remote_snapshots(replicating, settings, snapshots, held_snapshots)
+        states = dict((dataset, {'execute': due[dataset],
+                                 'replicate': dataset in replicating,
+                                 'local_snapshots': snapshots.get(dataset, []),
+                                 'held_snapshots': held_snapshots.get(dataset),
+                                 'remote_snapshots': remote_snapshots.get(dataset),
+                                 'groups': None,  # The pending replications, once estimated
+                                 'rate_limit': None,
+                                 'failed': False}) for dataset in datasets)
+
+        Manager.for_each(datasets, global_settings,
+                         lambda dataset: Manager.prepare(dataset, settings[dataset], states[dataset], remote_snapshots.get(dataset), now))
+        queue = Manager.get_queue(datasets, settings, states, now)
+        queued = set(queue)
+
+        def complete(dataset):
+            # A dataset is finished right after its own replication, without waiting for the others
+            if dataset in queued:
+                Manager.process_replication(dataset, settings[dataset], states[dataset], global_settings)
+            Manager.finish(dataset, settings[dataset], states[dataset], now)
+
+        # The datasets without replications are finished first, they don't have to wait for the queue
+        Manager.for_each([dataset for dataset in datasets if dataset not in queued] + queue, global_settings, complete)
+        Manager.clean_remote(datasets, settings, states, now)
+
+        Metrics.set('zsm_run_duration_seconds', {}, time.time() - start)
+        Metrics.set('zsm_run_commands', {}, Metrics.commands - commands)
+        Metrics.set('zsm_last_run_timestamp_seconds', {}, time.time())
+        if global_settings['metrics_file']:
+            try:
+                Metrics.write(global_settings['metrics_file'])
+            except Exception as ex:
+                Manager.logger.error('Exception while writing metrics: {0}'.format(str(ex)))
+
+    @staticmethod
+    def is_due(dataset, dataset_settings, local_snapshots, now):
+        """
+        Decides whether a dataset needs to be snapshotted and/or replicated in this run
+        """
+
+        today = '{0:04d}{1:02d}{2:02d}'.format(now.year, now.month, now.day)
+        try:
+            if dataset in Manager.requested:
+                Manager.requested.discard(dataset)
+                Manager.logger.info('Run requested for {0}'.format(dataset))
+                return True
+            if dataset_settings['snapshot'] is True or dataset_settings['replicate'] is not None:
+                if dataset_settings['time'] == 'trigger':
+                    # We wait until we find a trigger file in the filesystem
+                    trigger_filename = '{0}/.trigger'.format(dataset_settings['mountpoint'])
+                    if os.path.exists(trigger_filename):
+                        Manager.logger.info('Trigger found on {0}'.format(dataset))
+                        os.remove(trigger_filename)
+                        return True
+                else:
+                    trigger_time = dataset_settings['time'].split(':')
+                    hour = int(trigger_time[0])
+                    minutes = int(trigger_time[1])
+                    if (now.hour > hour or (now.hour == hour and now.minute >= minutes)) and today not in local_snapshots:
+                        Manager.logger.info('Time passed for {0}'.format(dataset))
+                        return True
+        except Exception as ex:
+            Manager.logger.error('Exception: {0}'.format(str(ex)))
+        return False
+
+    @staticmethod
+    def get_remote_snapshots(datasets, settings, local_snapshots=None, held_snapshots=None):
+        """
+        Retreives the snapshots of the replication partners of the given datasets (per dataset and replica name),
+        using a single listing per endpoint. Push targets aren't listed when the snapshot the journal recorded as
+        last replicated is still available and held locally, unless they need to be cleaned.
+        """
+
+        remote_datasets = {}
+        remote_snapshots = {}
+        for dataset in datasets:
+            for replica in settings[dataset]['replicate'] or []:
+                remote_dataset = replica['target'] if replica['target'] is not None else replica['source']
+                if replica['target'] is not None and Manager.is_tree(settings[dataset]) is False and local_snapshots is not None and \
+                        settings[dataset]['remote_schema'] is None:
+                    replicated = Journal.get_replicated(dataset, Manager.get_target_name(replica))
+                    if replicated is not None and replicated in local_snapshots.get(dataset, []) and \
+                            (replicated in held_snapshots.get(dataset, ()) or replica['bookmarks'] is True):
+                        remote_snapshots.setdefault(dataset, {})[replica['name']] = {remote_dataset: [replicated]}
+                        continue
+                remote_datasets.setdefault(replica['endpoint'], []).append((dataset, replica['name'], remote_dataset))
+        for endpoint in remote_datasets:
+            names = set(remote_dataset for _, _, remote_dataset in remote_datasets[endpoint])
+            trees = set(remote_dataset for dataset, _, remote_dataset in remote_datasets[endpoint] if Manager.is_tree(settings[dataset]) is True)
+            try:
+                with Metrics.labels(endpoint=endpoint):
+                    snapshots = ZFS.get_snapshots_many(sorted(names - trees), endpoint)
+                    snapshots.update(ZFS.get_snapshots_many(sorted(trees), endpoint, recursive=True))
+            except Exception as ex:
+                Manager.logger.error('Exception while listing snapshots on {0}: {1}'.format(endpoint or 'localhost', str(ex)))
+                continue
+            for dataset, name, remote_dataset in remote_datasets[endpoint]:
+                tree = remote_snapshots.setdefault(dataset, {})[name] = {}
+                if Manager.is_tree(settings[dataset]) is True:
+                    for remote_name in snapshots:
+                        if remote_name == remote_dataset or remote_name.startswith(remote_dataset + '/'):
+                            tree[remote_name] = snapshots[remote_name]
+                elif remote_dataset in snapshots:
+                    tree[remote_dataset] = snapshots[remote_dataset]
+        return remote_snapshots
+
+    @staticmethod
+    def for_each(datasets, global_settings, function):
+        """
+        Calls a function for every dataset, in the given order, using the configured number of workers
+        """
+
+        def worker(dataset):
+            pool_semaphore = Manager.get_semaphore('pool', dataset.split('/')[0], global_settings['pool_workers'])
+            if pool_semaphore is not None:
+                pool_semaphore.acquire()
+            try:
+                with Metrics.labels(dataset=dataset):
+                    function(dataset)
+            finally:
+                if pool_semaphore is not None:
+                    pool_semaphore.release()
+
+        if global_settings['workers'] > 1 and len(datasets) > 1:
+            pool = ThreadPool(min(global_settings['workers'], len(datasets)))
+            try:
+                # Handing out a single dataset at a time, the workers pick them up in order
+                for _ in pool.imap(worker, datasets, 1):
+                    pass
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for dataset in datasets:
+                worker(dataset)
+
+    @staticmethod
+    def prepare(dataset, dataset_settings, state, remote_snapshots, now):
+        """
+        Handles the first phases of a dataset: the pre execution command and the snapshot. Its pending replications
+        are estimated, so they can be queued.
+        """
+
+        today = '{0:04d}{1:02d}{2:02d}'.format(now.year, now.month, now.day)
+
+        try:
+            if state['execute'] is True:
+                # Pre exectution command
+                if dataset_settings['preexec'] is not None:
+                    with Metrics.timer('zsm_phase_duration_seconds', dataset=dataset, phase='preexec'):
+                        Helper.run_command(dataset_settings['preexec'], '/', timeout=Helper.hook_timeout)
+
+                if dataset_settings['snapshot'] is True and today in state['local_snapshots']:
+                    # E.g. a second trigger, or a requested run
+                    Manager.logger.info('Snapshot {0}@{1} already exists'.format(dataset, today))
+                elif dataset_settings['snapshot'] is True:
+                    # Take today's snapshotzfs
+                    Manager.logger.info('Taking snapshot {0}@{1}'.format(dataset, today))
+                    with Metrics.timer('zsm_phase_duration_seconds', dataset=dataset, phase='snapshot'):
+                        ZFS.snapshot(dataset, today, dataset_settings['recursive'])
+                    state['local_snapshots'].append(today)
+                    Manager.logger.info('Taking snapshot {0}@{1} complete'.format(dataset, today))
+
+            if state['replicate'] is True and dataset_settings['replicate'] is not None:
+                state['groups'] = Manager.plan(dataset, dataset_settings, state['local_snapshots'], remote_snapshots)
+
+        except Exception as ex:
+            Manager.logger.error('Exception: {0}'.format(str(ex)))
+            state['failed'] = True
+
+    @staticmethod
+    def get_queue(datasets, settings, states, now):
+        """
+        Returns the datasets to replicate, in the order of their priority and estimated size. Large replications towards
+        a remote endpoint outside of their window are deferred until it opens, or with a rate limit, throttled.
+        """
+
+        jobs = []
+        timestamp = time.time()
+        for dataset in datasets:
+            dataset_settings = settings[dataset]
+            state = states[dataset]
+            if state['failed'] is True or state['groups'] is None:
+                continue
+            size = sum(group['total'] for group in state['groups'])
+            remote = any(replica['endpoint'] != '' for group in state['groups'] for replica in group['replicas'])
+            window = dataset_settings['window']
+            if window is not None and remote is True and size > dataset_settings['window_size'] and not Scheduler.is_open(window, now):
+                if dataset_settings['window_rate'] is None:
+                    Manager.logger.info('Deferring replication of {0} ({1}) until {2}'.format(
+                        dataset, Helper.format_size(size), Scheduler.get_opening(window, now).strftime('%H:%M')))
+                    Manager.deferred.setdefault(dataset, timestamp)
+                    state['groups'] = None
+                    continue
+                Manager.logger.info('Limiting replication of {0} ({1}) to {2}/s until {3}'.format(
+                    dataset, Helper.format_size(size), dataset_settings['window_rate'],
+                    Scheduler.get_opening(window, now).strftime('%H:%M')))
+                state['rate_limit'] = dataset_settings['window_rate']
+            jobs.append({'dataset': dataset,
+                         'size': size,
+                         'priority': dataset_settings['priority'],
+                         'since': Manager.deferred.get(dataset, timestamp)})
+        jobs = Scheduler.order(jobs, timestamp)
+        Manager.queue = [{'dataset': job['dataset'], 'size': job['size'], 'status': 'queued'} for job in jobs]
+        return [job['dataset'] for job in jobs]
+
+    @staticmethod
+    def process_replication(dataset, dataset_settings, state, global_settings):
+        """
+        Sends the pending replications of a dataset, within the concurrency limits of its endpoints
+        """
+
+        Manager.deferred.pop(dataset, None)
+        job = [job for job in Manager.queue if job['dataset'] == dataset][0]
+        job['status'] = 'running'
+        try:
+            # The semaphores are always acquired in the same order, so datasets sharing endpoints can't deadlock
+            endpoint_semaphores = []
+            for endpoint in sorted(set(replica['endpoint'] for replica in dataset_settings['replicate'])):
+                endpoint_semaphore = Manager.get_semaphore('endpoint', endpoint, global_settings['endpoint_workers'])
+                if endpoint_semaphore is not None:
+                    endpoint_semaphores.append(endpoint_semaphore)
+            for endpoint_semaphore in endpoint_semaphores:
+                endpoint_semaphore.acquire()
+            try:
+                with Metrics.timer('zsm_phase_duration_seconds', dataset=dataset, phase='replicate'):
+                    Manager.replicate(dataset, dataset_settings, state['groups'], state['rate_limit'])
+            finally:
+                for endpoint_semaphore in endpoint_semaphores:
+                    endpoint_semaphore.release()
+                state['held_snapshots'] = None  # Replication moved the holds, they need to be retreived again
+            job['status'] = 'done'
+        except Exception as ex:
+            Manager.logger.error('Exception: {0}'.format(str(ex)))
+            job['status'] = 'failed'
+            state['failed'] = True
+
+    @staticmethod
+    def finish(dataset, dataset_settings, state, now):
+        """
+        Handles the last phases of a dataset: the post execution command and cleaning
+        """
+
+        yda = now - timedelta(1)
         today = '{0:04d}{1:02d}{2:02d}'.format(now.year, now.month, now.day)
         yesterday = '{0:04d}{1:02d}{2:02d}'.format(yda.year, yda.month, yda.day)
+        if state['failed'] is True:
+            return
+
+        try:
+            # Post execution command
+            if state['execute'] is True and dataset_settings['postexec'] is not None:
+                with Metrics.timer('zsm_phase_duration_seconds', dataset=dataset, phase='postexec'):
+                    Helper.run_command(dataset_settings['postexec'], '/', timeout=Helper.hook_timeout)
 
-        snapshots = ZFS.get_snapshots()
-        datasets = ZFS.get_datasets()
+            # Cleaning the snapshots (cleaning is mandatory)
+            local_snapshots = state['local_snapshots']
+            if today in local_snapshots or yesterday in local_snapshots:
+                with Metrics.timer('zsm_phase_duration_seconds', dataset=dataset, phase='clean'):
+                    Cleaner.clean(dataset, local_snapshots, dataset_settings['schema'], dataset_settings['recursive'], state['held_snapshots'])
+
+        except Exception as ex:
+            Manager.logger.error('Exception: {0}'.format(str(ex)))
+
+    @staticmethod
+    def clean_remote(datasets, settings, states, now):
+        """
+        Cleans the push targets of the sections with a remote schema, based on their listing taken before replicating.
+        The expired snapshots on an endpoint are destroyed with a single command for all its targets.
+        """
+
+        yda = now - timedelta(1)
+        recent = set('{0:04d}{1:02d}{2:02d}'.format(day.year, day.month, day.day) for day in [now, yda])
+        targets = {}
         for dataset in datasets:
-            if dataset in settings:
+            dataset_settings = settings[dataset]
+            state = states[dataset]
+            if dataset_settings['remote_schema'] is None or state['remote_snapshots'] is None or state['failed'] is True:
+                continue
+            for replica in dataset_settings['replicate'] or []:
+                if replica['target'] is None:
+                    continue
+                snapshots = state['remote_snapshots'].get(replica['name'], {}).get(replica['target'])
+                if not snapshots:
+                    continue
+                # The zsm hold is on the last replicated snapshot, the newest one at the time of the listing
+                held = set(snapshots[-1:])
+                replicated = Journal.get_replicated(dataset, Manager.get_target_name(replica))
+                if replicated is not None:
+                    held.add(replicated)
+                if not recent & (set(snapshots) | held):
+                    continue  # Just like locally, cleaning only happens while the snapshots keep coming
                 try:
-                    dataset_settings = settings[dataset]
-                    local_snapshots = snapshots.get(dataset, [])
-
-                    take_snapshot = dataset_settings['snapshot'] is True
-                    replicate = dataset_settings['replicate'] is not None
-
-                    # Decide whether we need to handle this dataset
-                    execute = False
-                    if take_snapshot is True or replicate is True:
-                        if dataset_settings['time'] == 'trigger':
-                            # We wait until we find a trigger file in the filesystem
-                            trigger_filename = '{0}/.trigger'.format(dataset_settings['mountpoint'])
-                            if os.path.exists(trigger_filename):
-                                Manager.logger.info('Trigger found on {0}'.format(dataset))
-                                os.remove(trigger_filename)
-                                execute = True
-                        else:
-                            trigger_time = dataset_settings['time'].split(':')
-                            hour = int(trigger_time[0])
-                            minutes = int(trigger_time[1])
-                            if (now.hour > hour or (now.hour == hour and now.minute >= minutes)) and today not in local_snapshots:
-                                Manager.logger.info('Time passed for {0}'.format(dataset))
-                                execute = True
-
-                    if execute is True:
-                        # Pre exectution command
-                        if dataset_settings['preexec'] is not None:
-                            Helper.run_command(dataset_settings['preexec'], '/')
-
-                        if take_snapshot is True:
-                            # Take today's snapshotzfs
-                            Manager.logger.info('Taking snapshot {0}@{1}'.format(dataset, today))
-                            ZFS.snapshot(dataset, today, dataset_settings['recursive'])
-                            local_snapshots.append(today)
-                            Manager.logger.info('Taking snapshot {0}@{1} complete'.format(dataset, today))
-
-                        # Replicating, if required
-                        if replicate is True:
-                            Manager.logger.info('Replicating {0}'.format(dataset))
-                            replicate_settings = dataset_settings['replicate']
-                            push = replicate_settings['target'] is not None
-                            remote_dataset = replicate_settings['target'] if push else replicate_settings['source']
-                            remote_snapshots = ZFS.get_snapshots(remote_dataset, replicate_settings['endpoint'])
-                            last_common_snapshot = None
-                            if remote_dataset in remote_snapshots:
-                                if push is True:  # If pushing, we search for the last local snapshot that is remotely available
-                                    for snapshot in local_snapshots:
-                                        if snapshot in remote_snapshots[remote_dataset]:
-                                            last_common_snapshot = snapshot
-                                else:  # Else, we search for the last remote snapshot that is locally available
-                                    for snapshot in remote_snapshots[remote_dataset]:
-                                        if snapshot in local_snapshots:
-                                            last_common_snapshot = snapshot
-                            if last_common_snapshot is not None:  # There's a common snapshot
-                                previous_snapshot = None
-                                if push is True:
-                                    for snapshot in local_snapshots:
-                                        if snapshot == last_common_snapshot:
-                                            previous_snapshot = last_common_snapshot
-                                            continue
-                                        if previous_snapshot is not None:
-                                            # There is a snapshot on this host that is not yet on the other side.
-                                            size = ZFS.get_size(dataset, previous_snapshot, snapshot)
-                                            Manager.logger.info('  {0}@{1} > {0}@{2} ({3})'.format(dataset, previous_snapshot, snapshot, size))
-                                            ZFS.replicate(dataset, previous_snapshot, snapshot, remote_dataset, replicate_settings.get('buffer_size', BUFFER_SIZE), replicate_settings['endpoint'], direction='push', compression=replicate_settings['compression'])
-                                            ZFS.hold(dataset, snapshot)
-                                            ZFS.hold(remote_dataset, snapshot, replicate_settings['endpoint'])
-                                            ZFS.release(dataset, previous_snapshot)
-                                            ZFS.release(remote_dataset, previous_snapshot, replicate_settings['endpoint'])
-                                            previous_snapshot = snapshot
-                                else:
-                                    for snapshot in remote_snapshots[remote_dataset]:
-                                        if snapshot == last_common_snapshot:
-                                            previous_snapshot = last_common_snapshot
-                                            continue
-                                        if previous_snapshot is not None:
-                                            # There is a remote snapshot that is not yet on the local host.
-                                            size = ZFS.get_size(remote_dataset, previous_snapshot, snapshot, replicate_settings['endpoint'])
-                                            Manager.logger.info('  {0}@{1} > {0}@{2} ({3})'.format(remote_dataset, previous_snapshot, snapshot, size))
-                                            ZFS.replicate(remote_dataset, previous_snapshot, snapshot, dataset, replicate_settings.get('buffer_size', BUFFER_SIZE), replicate_settings['endpoint'], direction='pull', compression=replicate_settings['compression'])
-                                            ZFS.hold(dataset, snapshot)
-                                            ZFS.hold(remote_dataset, snapshot, replicate_settings['endpoint'])
-                                            ZFS.release(dataset, previous_snapshot)
-                                            ZFS.release(remote_dataset, previous_snapshot, replicate_settings['endpoint'])
-                                            previous_snapshot = snapshot
-                            elif push is True and len(local_snapshots) > 0:
-                                # No common snapshot
-                                if remote_dataset not in remote_snapshots:
-                                    # No remote snapshot, full replication
-                                    snapshot = local_snapshots[-1]
-                                    size = ZFS.get_size(dataset, None, snapshot)
-                                    Manager.logger.info('  {0}@         > {0}@{1} ({2})'.format(dataset, snapshot, size))
-                                    ZFS.replicate(dataset, None, snapshot, remote_dataset, replicate_settings.get('buffer_size', BUFFER_SIZE), replicate_settings['endpoint'], direction='push', compression=replicate_settings['compression'])
-                                    ZFS.hold(dataset, snapshot)
-                                    ZFS.hold(remote_dataset, snapshot, replicate_settings['endpoint'])
-                            elif push is False and remote_dataset in remote_snapshots and len(remote_snapshots[remote_dataset]) > 0:
-                                # No common snapshot
-                                if len(local_snapshots) == 0:
-                                    # No local snapshot, full replication
-                                    snapshot = remote_snapshots[remote_dataset][-1]
-                                    size = ZFS.get_size(remote_dataset, None, snapshot, replicate_settings['endpoint'])
-                                    Manager.logger.info('  {0}@         > {0}@{1} ({2})'.format(remote_dataset, snapshot, size))
-                                    ZFS.replicate(remote_dataset, None, snapshot, dataset, replicate_settings.get('buffer_size', BUFFER_SIZE), replicate_settings['endpoint'], direction='pull', compression=replicate_settings['compression'])
-                                    ZFS.hold(dataset, snapshot)
-                                    ZFS.hold(remote_dataset, snapshot, replicate_settings['endpoint'])
-                            Manager.logger.info('Replicating {0} complete'.format(dataset))
-
-                        # Post execution command
-                        if dataset_settings['postexec'] is not None:
-                            Helper.run_command(dataset_settings['postexec'], '/')
-
-                    # Cleaning the snapshots (cleaning is mandatory)
-                    if today in local_snapshots or yesterday in local_snapshots:
-                        Cleaner.clean(dataset, local_snapshots, dataset_settings['schema'], dataset_settings['recursive'])
-
-                except Exception as ex:
-                    Manager.logger.error('Exception: {0}'.format(str(ex)))
+                    _, delete, _ = Cleaner.plan(snapshots, dataset_settings['remote_schema'], now, held)
+                except ValueError:
+                    Manager.logger.info('Got invalid remote schema for dataset {0}: {1}'.format(dataset, dataset_settings['remote_schema']))
+                    break
+                if delete:
+                    targets.setdefault(replica['endpoint'], []).append((replica, delete, Manager.is_tree(dataset_settings)))
+
+        for endpoint in sorted(targets):
+            for replica, delete, _ in targets[endpoint]:
+                Manager.logger.info('Cleaning {0}'.format(Manager.get_target_name(replica)))
+                for snapshot in delete:
+                    Manager.logger.info('  Destroying {0}@{1}'.format(replica['target'], snapshot))
+            try:
+                with Metrics.labels(endpoint=endpoint):
+                    destroyed = ZFS.destroy_remote([(replica['target'], delete, recursive) for replica, delete, recursive in targets[endpoint]],
+                                                   endpoint)
+                for replica, delete, _ in targets[endpoint]:
+                    for snapshot in delete:
+                        if snapshot not in destroyed[replica['target']]:
+                            Manager.logger.error('  Could not destroy {0}@{1}'.format(Manager.get_target_name(replica), snapshot))
+            except Exception as ex:
+                Manager.logger.error('Exception while cleaning {0}: {1}'.format(endpoint or 'localhost', str(ex)))
 
     @staticmethod
-    def start():
+    def plan(dataset, dataset_settings, local_snapshots, remote_snapshots=None):
         """
-        Main entry point
+        Determines the pending replications of a dataset towards (push) or from (pull) its configured replication
+        partners, and estimates their size. Push targets that have the same common snapshot are grouped, so they can
+        be fed from a single send stream.
         """
 
-        Manager.init_logger()
-        Manager.logger.info('Starting up')
+        recursive = Manager.is_tree(dataset_settings)
+        if remote_snapshots is None:
+            remote_snapshots = {}
+        if recursive is True:
+            # The whole tree is replicated, so the snapshots of all local descendants are needed as well
+            local_tree = ZFS.get_snapshots_many([dataset], recursive=True)
+        else:
+            local_tree = {dataset: local_snapshots}
+        groups = []  # The replicas that can be sent to together, with their common snapshot and the pending snapshots
+        for replica in dataset_settings['replicate']:
+            push = replica['target'] is not None
+            remote_dataset = replica['target'] if push else replica['source']
+            remote_tree = remote_snapshots.get(replica['name'])
+            if remote_tree is None:
+                remote_tree = ZFS.get_snapshots_many([remote_dataset], replica['endpoint'], recursive=recursive)
+            # The snapshots on the sending and the receiving side
+            source, target_dataset = (dataset, remote_dataset) if push is True else (remote_dataset, dataset)
+            source_tree, target_tree = (local_tree, remote_tree) if push is True else (remote_tree, local_tree)
+            source_snapshots = source_tree.get(source, [])
+            last_common_snapshot = Manager.get_common_snapshot(source, source_tree, target_dataset, target_tree)
+            target_snapshots = target_tree.get(target_dataset, [])
+            bookmark = None
+            if push is True and recursive is False and replica['bookmarks'] is True and target_snapshots and \
+                    target_snapshots[-1] not in source_snapshots:
+                # The last replicated snapshot might be cleaned already, while its bookmark is still there
+                bookmark, pending_snapshots = Manager.get_bookmark_base(dataset, replica, target_snapshots, last_common_snapshot)
+            if bookmark is not None:  # There's a more recent common bookmark
+                last_common_snapshot = bookmark
+            elif last_common_snapshot is not None:  # There's a common snapshot
+                pending_snapshots = source_snapshots[source_snapshots.index(last_common_snapshot) + 1:]
+            elif len(source_snapshots) > 0 and len(target_snapshots) == 0:
+                # No common snapshot, and no snapshot on the receiving side: full replication
+                pending_snapshots = source_snapshots[-1:]
+            else:
+                continue
+            Metrics.set('zsm_replication_lag_snapshots', {'dataset': dataset, 'target': Manager.get_target_name(replica)}, len(pending_snapshots))
+            if len(pending_snapshots) == 0:
+                continue
+            for group in groups:
+                if push is True and group['push'] is True and group['base'] == last_common_snapshot:
+                    group['replicas'].append(replica)
+                    break
+            else:
+                groups.append({'replicas': [replica], 'push': push, 'base': last_common_snapshot, 'pending': pending_snapshots})
+        for group in groups:
+            # The size of all pending snapshots is estimated once up front
+            replicate_settings = group['replicas'][0]  # The send options are shared by all replicas of a dataset
+            base_snapshot, pending_snapshots = group['base'], group['pending']
+            estimates = []
+            if base_snapshot is not None and base_snapshot.startswith('#') and len(pending_snapshots) > 1:
+                # A bookmark is only the base of the first snapshot, see catch_up
+                estimates.append(ZFS.get_sizes(dataset, base_snapshot, pending_snapshots[0],
+                                               send_flags=replicate_settings['send_flags']))
+                base_snapshot, pending_snapshots = pending_snapshots[0], pending_snapshots[1:]
+            estimates.append(ZFS.get_sizes(dataset if group['push'] is True else replicate_settings['source'],
+                                           base_snapshot, pending_snapshots[-1],
+                                           '' if group['push'] is True else replicate_settings['endpoint'],
+                                           intermediates=len(pending_snapshots) > 1,
+                                           send_flags=replicate_settings['send_flags'], recursive=recursive))
+            group['total'], group['sizes'] = 0, {}
+            for total, sizes in estimates:
+                if total is None:
+                    # The snapshots are sent anyway, they just don't count for the queue and the window
+                    Manager.logger.error('Could not estimate the size of the pending snapshots of {0}'.format(dataset))
+                    total = 0
+                group['total'] += total
+                group['sizes'].update(sizes)
+        return groups
+
+    @staticmethod
+    def get_bookmark_base(dataset, replica, target_snapshots, last_common_snapshot):
+        """
+        Looks for the most recent bookmark of a replica of which the snapshot is still available on the target. Returns
+        the bookmark (as #bookmark) and the snapshots created after it, or None if there is no such bookmark more
+        recent than the last common snapshot.
+        """
+
+        prefix = '#{0}.'.format(Manager.get_tag(replica))
+        target_snapshots = set(target_snapshots)
+        history = ZFS.get_history(dataset)
+        for index in range(len(history) - 1, -1, -1):
+            if history[index] == '@{0}'.format(last_common_snapshot):
+                break
+            if history[index].startswith(prefix) and history[index][len(prefix):] in target_snapshots:
+                return history[index], [name[1:] for name in history[index + 1:] if name.startswith('@')]
+        return None, None
+
+    @staticmethod
+    def replicate(dataset, dataset_settings, groups, rate_limit=None):
+        """
+        Sends the planned replications of a dataset, group by group
+        """
+
+        Manager.logger.info('Replicating {0}'.format(dataset))
+        errors = []
+        for group in groups:
+            try:
+                with Metrics.labels(endpoint=','.join(sorted(set(replica['endpoint'] for replica in group['replicas'])))):
+                    errors.extend(Manager.catch_up(dataset, group['replicas'], group['base'], group['pending'], group['push'],
+                                                   group['total'], group['sizes'], Manager.is_tree(dataset_settings), rate_limit))
+            except Exception as ex:
+                for replica in group['replicas']:
+                    Journal.forget(dataset, Manager.get_target_name(replica))
+                errors.append(str(ex))
+        if errors:
+            raise RuntimeError('; '.join(errors))
+        Manager.logger.info('Replicating {0} complete'.format(dataset))
+
+    @staticmethod
+    def catch_up(dataset, replicas, base_snapshot, pending_snapshots, push, total, sizes, recursive=False, rate_limit=None):
+        """
+        Sends the pending snapshots to a group of replicas, one by one or in a single stream, given their estimated
+        total size and size per snapshot. Replicas that fail are left out of the remaining sends, their errors are
+        returned.
+        """
+
+        replicate_settings = replicas[0]  # The send options are shared by all replicas of a dataset
+        endpoints = [replica['endpoint'] for replica in replicas]
+        if not pending_snapshots:
+            return []
+        if len(pending_snapshots) > 1:
+            Manager.logger.info('  {0} snapshots pending, {1}{2}'.format(len(pending_snapshots), Helper.format_size(total),
+                                                                         Manager.format_eta(endpoints, total)))
+        Manager.set_pending(dataset, replicas, len(pending_snapshots), total)
+
+        errors = []
+        failed = []
+        if base_snapshot is None or recursive is True or (replicate_settings['single_stream'] is True and len(pending_snapshots) > 1):
+            if base_snapshot is not None and base_snapshot.startswith('#') and len(pending_snapshots) > 1:
+                # A stream from a bookmark can't contain intermediate snapshots, so the first snapshot is sent on its own
+                size = sizes.get(pending_snapshots[0], 0)
+                failed = Manager.send(dataset, replicas, base_snapshot, pending_snapshots[0], push, size, rate_limit=rate_limit)
+                errors.extend(error for _, error in failed)
+                replicas = [replica for replica in replicas if replica not in [failed_replica for failed_replica, _ in failed]]
+                if not replicas:
+                    return errors
+                base_snapshot, pending_snapshots, total = pending_snapshots[0], pending_snapshots[1:], max(total - size, 0)
+            # Send all snapshots that are not yet on the receiving side in a single stream
+            failed = Manager.send(dataset, replicas, base_snapshot, pending_snapshots[-1], push, total, len(pending_snapshots), recursive,
+                                  rate_limit)
+            errors.extend(error for _, error in failed)
+        else:
+            previous_snapshot = base_snapshot
+            remaining = total
+            for index, snapshot in enumerate(pending_snapshots):
+                # There is a snapshot that is not yet on the receiving side.
+                size = sizes.get(snapshot, 0)
+                failed = Manager.send(dataset, replicas, previous_snapshot, snapshot, push, size, rate_limit=rate_limit)
+                errors.extend(error for _, error in failed)
+                replicas = [replica for replica in replicas if replica not in [failed_replica for failed_replica, _ in failed]]
+                if not replicas:
+                    return errors
+                remaining = max(remaining - size, 0)
+                Manager.set_pending(dataset, replicas, len(pending_snapshots) - index - 1, remaining)
+                if index < len(pending_snapshots) - 1:
+                    Manager.logger.info('  {0} of {1} sent, {2} remaining{3}'.format(
+                        Helper.format_size(total - remaining), Helper.format_size(total), Helper.format_size(remaining),
+                        Manager.format_eta([replica['endpoint'] for replica in replicas], remaining)))
+                previous_snapshot = snapshot
+        Manager.set_pending(dataset, [replica for replica in replicas if replica not in [failed_replica for failed_replica, _ in failed]], 0, 0)
+        return errors
+
+    @staticmethod
+    def set_pending(dataset, replicas, snapshots, size):
+        """
+        Updates the replication lag of the given replicas
+        """
+
+        for replica in replicas:
+            labels = {'dataset': dataset, 'target': Manager.get_target_name(replica)}
+            Metrics.set('zsm_replication_lag_snapshots', labels, snapshots)
+            Metrics.set('zsm_replication_pending_bytes', labels, size)
+
+    @staticmethod
+    def format_eta(endpoints, size):
+        """
+        Formats the estimated time to send the given number of bytes, if it can be estimated
+        """
+
+        eta = Metrics.get_eta(endpoints, size)
+        if eta is None:
+            return ''
+        return ', ETA {0}'.format(timedelta(seconds=int(eta)))
+
+    @staticmethod
+    def get_common_snapshot(source, source_tree, target, target_tree):
+        """
+        Returns the most recent snapshot of the source dataset that is available on the receiving side, for the
+        dataset itself and all its descendants (in the given trees) that have this snapshot
+        """
+
+        source_sets = dict((name, set(snapshots)) for name, snapshots in source_tree.iteritems()
+                           if name == source or name.startswith(source + '/'))
+        target_sets = dict((name, set(snapshots)) for name, snapshots in target_tree.iteritems())
+        for snapshot in reversed(source_tree.get(source, [])):
+            if all(snapshot in target_sets.get(target + name[len(source):], ())
+                   for name, snapshots in source_sets.iteritems() if snapshot in snapshots):
+                return snapshot
+        return None
+
+    @staticmethod
+    def is_tree(dataset_settings):
+        """
+        Checks whether a section replicates its dataset together with all descendants
+        """
+
+        return dataset_settings['recursive'] is True and dataset_settings['replicate_recursive'] is True
+
+    @staticmethod
+    def get_target_name(replica):
+        """
+        Returns a readable name of a replication partner
+        """
+
+        remote_dataset = replica['target'] if replica['target'] is not None else replica['source']
+        return '{0}{1}'.format(replica['endpoint'] + ':' if replica['endpoint'] else '', remote_dataset)
+
+    @staticmethod
+    def get_tag(replica):
+        """
+        Returns the tag of the holds (or bookmarks) a replica places on the local snapshots
+        """
+
+        return 'zsm_{0}'.format(replica['name']) if replica['name'] else 'zsm'
+
+    @staticmethod
+    def send(dataset, replicas, base_snapshot, snapshot, push, size, count=1, recursive=False, rate_limit=None):
+        """
+        Sends a snapshot (or with count > 1, all snapshots up to it) of the given estimated size and moves the zsm
+        holds to it. When pushing to multiple replicas, a single send stream feeds all of them.
+        With recursive, all descendants are sent along in the same stream. A rate limit throttles the stream.
+        Returns the replicas that failed, with their error
+        """
+
+        replicate_settings = replicas[0]  # The send options are shared by all replicas of a dataset
+        endpoint = replicate_settings['endpoint']
+        source = dataset if push is True else replicate_settings['source']
+        intermediates = count > 1
+        human_size = Helper.format_size(size)
+        # With a bookmark as base, the receiving side has the bookmarked snapshot
+        remote_base_snapshot = base_snapshot.split('.', 1)[1] if base_snapshot is not None and base_snapshot.startswith('#') else base_snapshot
+        if base_snapshot is None:
+            Manager.logger.info('  {0}@         > {0}@{1} ({2})'.format(source, snapshot, human_size))
+        elif intermediates is True:
+            Manager.logger.info('  {0}@{1} >> {0}@{2} ({3}, {4} snapshots)'.format(source, base_snapshot, snapshot, human_size, count))
+        else:
+            Manager.logger.info('  {0}{1}{2} > {0}@{3} ({4})'.format(source, '' if base_snapshot.startswith('#') else '@', base_snapshot,
+                                                                     snapshot, human_size))
+        if len(replicas) > 1:
+            Manager.logger.info('  Sending to {0}'.format(', '.join(Manager.get_target_name(replica) for replica in replicas)))
+        compressions = []
+        for replica in replicas:
+            Journal.start_transfer(dataset, Manager.get_target_name(replica), base_snapshot, snapshot)
+            compression = replica['compression']
+            if compression == 'auto':
+                compression = Compression.choose(replica['endpoint'], size)
+                Manager.logger.info('  Using compression {0} towards {1}'.format(compression or 'none', Manager.get_target_name(replica)))
+            compressions.append(compression)
+        start = time.time()
+        for replica in replicas:
+            Manager.transfers[Manager.get_target_name(replica)] = {'dataset': dataset, 'target': Manager.get_target_name(replica),
+                                                                   'snapshot': snapshot, 'size': size, 'started': start,
+                                                                   'endpoint': replica['endpoint']}
+        try:
+            if len(replicas) == 1:
+                target = replicate_settings['target'] if push is True else dataset
+                try:
+                    ZFS.replicate(source, base_snapshot, snapshot, target, replicate_settings.get('buffer_size', BUFFER_SIZE), endpoint,
+                                  direction='push' if push is True else 'pull', compression=compressions[0],
+                                  intermediates=intermediates, resumable=replicate_settings['resumable'],
+                                  send_flags=replicate_settings['send_flags'], recursive=recursive, rate_limit=rate_limit)
+                except Exception:
+                    Journal.forget(dataset, Manager.get_target_name(replicate_settings))
+                    raise
+                errors = [None]
+            else:
+                errors = ZFS.replicate_many(source, base_snapshot, snapshot,
+                                            [(replica['target'], replica['endpoint'], compression) for replica, compression in zip(replicas, compressions)],
+                                            replicate_settings.get('buffer_size', BUFFER_SIZE), intermediates=intermediates,
+                                            resumable=replicate_settings['resumable'], send_flags=replicate_settings['send_flags'],
+                                            recursive=recursive, rate_limit=rate_limit)
+        finally:
+            for replica in replicas:
+                Manager.transfers.pop(Manager.get_target_name(replica), None)
+        duration = time.time() - start
+        failed = []
+        for replica, compression, error in zip(replicas, compressions, errors):
+            if error is not None:
+                Manager.logger.error('  Replicating to {0} failed: {1}'.format(Manager.get_target_name(replica), error))
+                Journal.forget(dataset, Manager.get_target_name(replica))
+                failed.append((replica, error))
+                continue
+            Journal.finish_transfer(dataset, Manager.get_target_name(replica), snapshot)
+            Metrics.record_transfer(dataset, replica['endpoint'], size, duration)
+            if replica['compression'] == 'auto':
+                Compression.record(replica['endpoint'], compression, size, duration)
+            # Every push target holds its own tag on the local snapshots, so their holds don't interfere
+            tag = Manager.get_tag(replica)
+            remote_dataset = replica['target'] if push is True else replica['source']
+            if push is True and recursive is False and replica['bookmarks'] is True:
+                ZFS.bookmark(dataset, snapshot, tag, remote_base_snapshot)
+            else:
+                ZFS.hold(dataset, snapshot, recursive=recursive, tag=tag)
+                if base_snapshot is not None:
+                    ZFS.release(dataset, base_snapshot, recursive=recursive, tag=tag)
+            ZFS.hold(remote_dataset, snapshot, replica['endpoint'], recursive)
+            if base_snapshot is not None:
+                ZFS.release(remote_dataset, remote_base_snapshot, replica['endpoint'], recursive)
+            Journal.record_hold(dataset, Manager.get_target_name(replica), snapshot)
+        return failed
+
+    @staticmethod
+    def handle_request(request, settings):
+        """
+        Answers a request received over the control socket
+        """
+
+        command = request.get('command')
+        dataset = request.get('dataset')
+        if command == 'run':
+            if dataset not in settings:
+                return {'error': 'Unknown section {0}'.format(dataset)}
+            Manager.requested.add(dataset)
+            Scheduler.wake()
+            return {'result': 'Run of {0} requested'.format(dataset)}
+        if command == 'status':
+            now = time.time()
+            transfers = []
+            for transfer in sorted(Manager.transfers.values(), key=lambda item: item['started']):
+                eta = Metrics.get_eta([transfer['endpoint']], transfer['size'])
+                transfers.append(dict(transfer, eta=max(0, eta - (now - transfer['started'])) if eta is not None else None))
+            return {'queue': [dict(job) for job in Manager.queue],
+                    'transfers': transfers,
+                    'deferred': dict(Manager.deferred)}
+        if command == 'inventory':
+            with Inventory.lock:
+                if dataset is not None:
+                    if dataset not in Inventory.snapshots:
+                        return {'error': 'Unknown dataset {0}'.format(dataset)}
+                    return {'snapshots': list(Inventory.snapshots[dataset])}
+                return {'inventory': dict((name, {'count': len(snapshots),
+                                                  'oldest': snapshots[0] if snapshots else None,
+                                                  'newest': snapshots[-1] if snapshots else None})
+                                          for name, snapshots in Inventory.snapshots.items())}
+        if command == 'lag':
+            lag = {}
+            for labels, value in Metrics.get('zsm_replication_lag_snapshots'):
+                lag.setdefault((labels['dataset'], labels['target']), {'snapshots': 0, 'bytes': 0})['snapshots'] = int(value)
+            for labels, value in Metrics.get('zsm_replication_pending_bytes'):
+                lag.setdefault((labels['dataset'], labels['target']), {'snapshots': 0, 'bytes': 0})['bytes'] = int(value)
+            return {'lag': [dict(values, dataset=key[0], target=key[1]) for key, values in sorted(lag.items())]}
+        return {'error': 'Unknown command {0}'.format(command)}
+
+    @staticmethod
+    def load_config(filename):
+        """
+        Parses the configuration file into the settings per dataset and the global settings
+        """
 
         settings = {}
+        global_settings = {'workers': 1,
+                           'endpoint_workers': 1,
+                           'pool_workers': 0,
+                           'inventory_interval': 3600,
+                           'ssh_persist': 600,
+                           'max_sleep': 3600,
+                           'compression_interval': 86400,
+                           'metrics_file': '',
+                           'journal_file': '/var/lib/zfs-snap-manager/journal.db',
+                           'aging_interval': 3600,
+                           'replicate_window': '',
+                           'replicate_window_size': 1024,
+                           'replicate_window_rate': '',
+                           'command_timeout': 1800,
+                           'stream_timeout': 0,
+                           'stall_timeout': 600,
+                           'hook_timeout': 0,
+                           'control_socket': '/var/run/zfs-snap-manager/control.sock'}
         try:
             config = ConfigParser.RawConfigParser()
-            config.read('/etc/zfssnapmanager.cfg')
+            config.read(filename)
+            if config.has_section(GLOBAL_SECTION):
+                for key in global_settings:
+                    if config.has_option(GLOBAL_SECTION, key):
+                        if isinstance(global_settings[key], int):
+                            global_settings[key] = config.getint(GLOBAL_SECTION, key)
+                        else:
+                            global_settings[key] = config.get(GLOBAL_SECTION, key)
             for dataset in config.sections():
+                if dataset == GLOBAL_SECTION:
+                    continue
                 settings[dataset] = {'mountpoint': config.get(dataset, 'mountpoint') if config.has_option(dataset, 'mountpoint') else None,
                                      'time': config.get(dataset, 'time'),
                                      'snapshot': config.getboolean(dataset, 'snapshot'),
                                      'recursive': config.getboolean(dataset, 'recursive') if config.has_option(dataset, 'recursive') else False,
+                                     'replicate_recursive': config.getboolean(dataset, 'replicate_recursive')
+                                     if config.has_option(dataset, 'replicate_recursive') else False,
                                      'replicate': None,
                                      'schema': config.get(dataset, 'schema'),
                                      'preexec': config.get(dataset, 'preexec') if config.has_option(dataset, 'preexec') else None,
-                                     'postexec': config.get(dataset, 'postexec') if config.has_option(dataset, 'postexec') else None}
+                                     'postexec': config.get(dataset, 'postexec') if config.has_option(dataset, 'postexec') else None,
+                                     'priority': config.getint(dataset, 'priority') if config.has_option(dataset, 'priority') else 0,
+                                     'remote_schema': config.get(dataset, 'remote_schema') if config.has_option(dataset, 'remote_schema') else None}
+                # The replication window, by default the one of the global section
+                window = config.get(dataset, 'replicate_window') if config.has_option(dataset, 'replicate_window') \
+                    else global_settings['replicate_window']
+                window_size = config.getint(dataset, 'replicate_window_size') if config.has_option(dataset, 'replicate_window_size') \
+                    else global_settings['replicate_window_size']
+                window_rate = config.get(dataset, 'replicate_window_rate') if config.has_option(dataset, 'replicate_window_rate') \
+                    else global_settings['replicate_window_rate']
+                if window:
+                    Scheduler.parse_window(window)
+                settings[dataset].update({'window': window or None,
+                                          'window_size': window_size * 1024 * 1024,
+                                          'window_rate': window_rate or None})
+                replicas = []
                 if config.has_option(dataset, 'replicate_endpoint') and (config.has_option(dataset, 'replicate_target') or
                                                                          config.has_option(dataset, 'replicate_source')):
-                    settings[dataset]['replicate'] = {'endpoint': config.get(dataset, 'replicate_endpoint'),
-                                                      'target': config.get(dataset, 'replicate_target')
-                                                      if config.has_option(dataset, 'replicate_target') else None,
-                                                      'source': config.get(dataset, 'replicate_source')
-                                                      if config.has_option(dataset, 'replicate_source') else None,
-                                                      'compression': config.get(dataset, 'compression')
-                                                      if config.has_option(dataset, 'compression') else None}
+                    replicas.append({'name': '',
+                                     'endpoint': config.get(dataset, 'replicate_endpoint'),
+                                     'target': config.get(dataset, 'replicate_target')
+                                     if config.has_option(dataset, 'replicate_target') else None,
+                                     'source': config.get(dataset, 'replicate_source')
+                                     if config.has_option(dataset, 'replicate_source') else None})
+                for option in sorted(config.options(dataset)):
+                    # Additional push targets, e.g. replicate_target_offsite with replicate_endpoint_offsite
+                    match = re.match(r'^replicate_target_(\w+)$', option)
+                    if match is not None:
+                        name = match.group(1)
+                        replicas.append({'name': name,
+                                         'endpoint': config.get(dataset, 'replicate_endpoint_' + name)
+                                         if config.has_option(dataset, 'replicate_endpoint_' + name) else '',
+                                         'target': config.get(dataset, option),
+                                         'source': None})
+                for replica in replicas:
+                    replica.update({'compression': config.get(dataset, 'compression')
+                                    if config.has_option(dataset, 'compression') else None,
+                                    'single_stream': config.getboolean(dataset, 'single_stream')
+                                    if config.has_option(dataset, 'single_stream') else False,
+                                    'resumable': config.getboolean(dataset, 'resumable')
+                                    if config.has_option(dataset, 'resumable') else False,
+                                    'bookmarks': config.getboolean(dataset, 'bookmarks')
+                                    if config.has_option(dataset, 'bookmarks') else False,
+                                    'send_flags': ' '.join(flag for option, flag in SEND_FLAGS
+                                                           if config.has_option(dataset, option) and
+                                                           config.getboolean(dataset, option))})
+                if replicas:
+                    settings[dataset]['replicate'] = replicas
         except Exception as ex:
             Manager.logger.error('Exception while parsing configuration file: {0}'.format(str(ex)))
 
+        return settings, global_settings
+
+    @staticmethod
+    def configure(global_settings):
+        """
+        Applies the global settings to the different components
+        """
+
+        Inventory.interval = global_settings['inventory_interval']
+        SSH.persist = global_settings['ssh_persist']
+        Helper.timeout = global_settings['command_timeout']
+        Helper.stream_timeout = global_settings['stream_timeout']
+        Helper.stall_timeout = global_settings['stall_timeout']
+        Helper.hook_timeout = global_settings['hook_timeout']
+        Scheduler.max_sleep = global_settings['max_sleep']
+        Scheduler.aging_interval = global_settings['aging_interval']
+        Compression.interval = global_settings['compression_interval']
+        try:
+            Journal.open(global_settings['journal_file'])
+            for dataset, target, base_snapshot, snapshot, _ in Journal.get_transfers():
+                # The daemon stopped during this transfer, the target will be listed again to pick it up
+                Manager.logger.info('Transfer of {0}@{1} to {2} was interrupted'.format(dataset, snapshot, target))
+                Journal.forget(dataset, target)
+        except Exception as ex:
+            Manager.logger.error('Exception while opening the journal: {0}'.format(str(ex)))
+
+    @staticmethod
+    def start():
+        """
+        Main entry point
+        """
+
+        Manager.init_logger()
+        Manager.logger.info('Starting up')
+
+        settings, global_settings = Manager.load_config('/etc/zfssnapmanager.cfg')
+        Manager.configure(global_settings)
+        try:
+            Control.start(global_settings['control_socket'], lambda request: Manager.handle_request(request, settings))
+        except Exception as ex:
+            Manager.logger.error('Exception while opening the control socket: {0}'.format(str(ex)))
+
         while True:
+            started = time.time()
             try:
-                Manager.run(settings)
+                Manager.run(settings, global_settings)
             except Exception as ex:
                 Manager.logger.error('Exception: {0}'.format(str(ex)))
-            time.sleep(5 * 60)
+            try:
+                Scheduler.wait(settings, Manager.deferred, started)
+            except Exception as ex:
+                Manager.logger.error('Exception while waiting: {0}'.format(str(ex)))
+                time.sleep(5 * 60)
 
 
 if __name__ == '__main__':
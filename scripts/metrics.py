@@ -0,0 +1,184 @@
+# Copyright (c) 2014 Kenneth Henderick <kenneth@ketronic.be>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Provides functionality for collecting metrics and exporting them for the Prometheus textfile collector
+"""
+
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+DESCRIPTIONS = {'zsm_commands_total': ('counter', 'Commands executed, per operation and exit code'),
+                'zsm_command_duration_seconds_total': ('counter', 'Time spent in commands, per operation'),
+                'zsm_replicated_bytes_total': ('counter', 'Estimated bytes sent by replication'),
+                'zsm_replication_duration_seconds_total': ('counter', 'Time spent sending snapshots'),
+                'zsm_replication_throughput_bytes_per_second': ('gauge', 'Throughput of the last replication stream'),
+                'zsm_replication_lag_snapshots': ('gauge', 'Snapshots not yet replicated to the target'),
+                'zsm_replication_pending_bytes': ('gauge', 'Estimated bytes not yet replicated to the target'),
+                'zsm_last_replication_timestamp_seconds': ('gauge', 'Time of the last successful replication stream'),
+                'zsm_phase_duration_seconds': ('gauge', 'Duration of the phases of the last handling of a dataset'),
+                'zsm_run_duration_seconds': ('gauge', 'Duration of the last run'),
+                'zsm_run_commands': ('gauge', 'Commands executed during the last run'),
+                'zsm_last_run_timestamp_seconds': ('gauge', 'Time at which the last run finished')}
+
+
+class Metrics(object):
+    """
+    Collects timings and counters of the commands and the manager's phases
+    """
+
+    lock = threading.Lock()
+    values = {}  # Value per (metric name, sorted label items)
+    context = threading.local()  # Labels applied to the commands executed by the current thread
+    commands = 0  # Commands executed since the last reset
+    throughputs = {}  # Smoothed replication throughput per endpoint, in bytes per second
+
+    @staticmethod
+    @contextmanager
+    def labels(**labels):
+        """
+        Applies the given labels to all commands executed by the current thread within the context
+        """
+
+        previous = getattr(Metrics.context, 'labels', {})
+        Metrics.context.labels = dict(previous, **labels)
+        try:
+            yield
+        finally:
+            Metrics.context.labels = previous
+
+    @staticmethod
+    @contextmanager
+    def timer(name, **labels):
+        """
+        Sets a gauge to the duration of the context
+        """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            Metrics.set(name, labels, time.time() - start)
+
+    @staticmethod
+    def add(name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with Metrics.lock:
+            Metrics.values[key] = Metrics.values.get(key, 0) + value
+
+    @staticmethod
+    def set(name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with Metrics.lock:
+            Metrics.values[key] = value
+
+    @staticmethod
+    def get(name):
+        """
+        Returns the labels and value of all series of a metric
+        """
+
+        with Metrics.lock:
+            return [(dict(key[1]), value) for key, value in Metrics.values.items() if key[0] == name]
+
+    @staticmethod
+    def record_command(command, duration, return_code):
+        """
+        Records a command executed by the helper, labeled with its zfs operation
+        """
+
+        match = re.search(r'\bzfs\s+(\w+)(\s+-n)?', command)
+        if match is None:
+            operation = 'exec'
+        elif match.group(2) is not None:
+            operation = '{0}_estimate'.format(match.group(1))
+        else:
+            operation = match.group(1)
+        labels = dict(getattr(Metrics.context, 'labels', {}), operation=operation)
+        labels.setdefault('dataset', '')
+        labels.setdefault('endpoint', '')
+        Metrics.add('zsm_commands_total', dict(labels, exit_code=str(return_code)))
+        Metrics.add('zsm_command_duration_seconds_total', labels, duration)
+        with Metrics.lock:
+            Metrics.commands += 1
+
+    @staticmethod
+    def record_transfer(dataset, endpoint, size, duration):
+        """
+        Records a replication stream
+        """
+
+        labels = {'dataset': dataset, 'endpoint': endpoint}
+        Metrics.add('zsm_replicated_bytes_total', labels, size)
+        Metrics.add('zsm_replication_duration_seconds_total', labels, duration)
+        if duration > 0 and size > 0:  # Empty (or unestimated) streams say nothing about the throughput
+            Metrics.set('zsm_replication_throughput_bytes_per_second', labels, size / duration)
+            with Metrics.lock:
+                previous = Metrics.throughputs.get(endpoint)
+                Metrics.throughputs[endpoint] = size / duration if previous is None else (previous + size / duration) / 2
+        Metrics.set('zsm_last_replication_timestamp_seconds', labels, time.time())
+
+    @staticmethod
+    def get_eta(endpoints, size):
+        """
+        Estimates the seconds needed to send the given number of bytes to the slowest of the given endpoints, based
+        on the measured throughput. Returns None when there are no measurements yet.
+        """
+
+        with Metrics.lock:
+            throughputs = [Metrics.throughputs.get(endpoint) for endpoint in endpoints]
+        if not throughputs or None in throughputs or min(throughputs) <= 0:
+            return None
+        return size / min(throughputs)
+
+    @staticmethod
+    def render():
+        """
+        Renders all metrics in the Prometheus text format
+        """
+
+        with Metrics.lock:
+            values = dict(Metrics.values)
+        lines = []
+        for name in sorted(set(key[0] for key in values)):
+            metric_type, description = DESCRIPTIONS.get(name, ('untyped', name))
+            lines.append('# HELP {0} {1}'.format(name, description))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+            for key in sorted(key for key in values if key[0] == name):
+                labels = ','.join('{0}="{1}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                                  for label, value in key[1])
+                lines.append('{0}{{{1}}} {2}'.format(name, labels, repr(float(values[key]))) if labels else
+                             '{0} {1}'.format(name, repr(float(values[key]))))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def write(filename):
+        """
+        Writes the metrics to a file, atomically replacing the previous version
+        """
+
+        temporary_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(temporary_filename, 'w') as metrics_file:
+            metrics_file.write(Metrics.render())
+        os.rename(temporary_filename, filename)
@@ -0,0 +1,243 @@
+# Copyright (c) 2014 Kenneth Henderick <kenneth@ketronic.be>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Provides functionality for deciding when the manager needs to run
+"""
+
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+class Scheduler(object):
+    """
+    Sleeps until the next configured time, or until a trigger file shows up. Also orders the replication jobs of a
+    run and decides which of them fit in their endpoint's time window.
+    """
+
+    logger = None  # The manager will fill this object
+    max_sleep = 3600  # Maximum number of seconds between two runs
+    aging_interval = 3600  # Seconds of waiting after which a replication job counts as half its size
+    poll_interval = 5  # Seconds between trigger file checks when inotify is not available
+    inotify = None  # The inotify file descriptor, False if inotify is not available
+    libc = None
+    wake_pipe = None  # Written to by wake(), to interrupt a wait. Created on first use, after daemonizing.
+    wake_lock = threading.Lock()
+
+    @staticmethod
+    def get_next_time(settings, now, deferred=()):
+        """
+        Calculates the first moment after now at which a time-based dataset becomes due, or the window of a deferred
+        replication opens
+        """
+
+        next_time = None
+        for dataset in settings:
+            dataset_settings = settings[dataset]
+            if dataset in deferred and dataset_settings['window'] is not None:
+                candidate = Scheduler.get_opening(dataset_settings['window'], now)
+                if next_time is None or candidate < next_time:
+                    next_time = candidate
+            if dataset_settings['time'] == 'trigger':
+                continue
+            if dataset_settings['snapshot'] is not True and dataset_settings['replicate'] is None:
+                continue
+            trigger_time = dataset_settings['time'].split(':')
+            candidate = now.replace(hour=int(trigger_time[0]), minute=int(trigger_time[1]), second=0, microsecond=0)
+            if candidate <= now:
+                candidate += timedelta(1)
+            if next_time is None or candidate < next_time:
+                next_time = candidate
+        return next_time
+
+    @staticmethod
+    def get_trigger_files(settings):
+        """
+        Returns the trigger files of the trigger-based datasets
+        """
+
+        trigger_files = []
+        for dataset in settings:
+            dataset_settings = settings[dataset]
+            if dataset_settings['time'] == 'trigger' and dataset_settings['mountpoint']:
+                if dataset_settings['snapshot'] is True or dataset_settings['replicate'] is not None:
+                    trigger_files.append('{0}/.trigger'.format(dataset_settings['mountpoint']))
+        return trigger_files
+
+    @staticmethod
+    def order(jobs, now):
+        """
+        Orders replication jobs, given as dicts with their dataset, estimated size, priority and the time since which
+        they're waiting. Higher priorities go first, then the smallest jobs. The size of a job that is waiting is
+        divided by the number of aging intervals it waited (plus one), so large jobs aren't postponed forever.
+        """
+
+        def key(job):
+            waited = max(now - job['since'], 0)
+            aging = float(waited) / Scheduler.aging_interval if Scheduler.aging_interval > 0 else 0
+            return -job['priority'], job['size'] / (1.0 + aging), job['dataset']
+
+        return sorted(jobs, key=key)
+
+    @staticmethod
+    def parse_window(window):
+        """
+        Parses a time window like 22:00-06:00 into its start and end, in minutes after midnight
+        """
+
+        match = re.match(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$', window)
+        if match is None:
+            raise ValueError('Invalid time window: {0}'.format(window))
+        hours = [int(value) for value in match.groups()]
+        return hours[0] * 60 + hours[1], hours[2] * 60 + hours[3]
+
+    @staticmethod
+    def is_open(window, now):
+        """
+        Checks whether now is within a time window. Windows may span midnight.
+        """
+
+        start, end = Scheduler.parse_window(window)
+        minutes = now.hour * 60 + now.minute
+        if start <= end:
+            return start <= minutes < end
+        return minutes >= start or minutes < end
+
+    @staticmethod
+    def get_opening(window, now):
+        """
+        Calculates the first moment after now at which a time window opens
+        """
+
+        start, _ = Scheduler.parse_window(window)
+        opening = now.replace(hour=start // 60, minute=start % 60, second=0, microsecond=0)
+        if opening <= now:
+            opening += timedelta(1)
+        return opening
+
+    @staticmethod
+    def wait(settings, deferred=(), since=None):
+        """
+        Blocks until the next time-based dataset is due, the window of a deferred replication opens, a trigger file
+        is created or the maximum sleep time passed. Trigger files older than since (the start of the last run) were
+        left behind by that run, e.g. because the dataset doesn't exist, and don't end the wait.
+        """
+
+        now = datetime.now()
+        timeout = Scheduler.max_sleep
+        next_time = Scheduler.get_next_time(settings, now, deferred)
+        if next_time is not None:
+            delta = next_time - now
+            timeout = min(timeout, delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0)
+        Scheduler.wait_for_triggers(Scheduler.get_trigger_files(settings), timeout, since)
+
+    @staticmethod
+    def wait_for_triggers(trigger_files, timeout, since=None):
+        """
+        Blocks until one of the trigger files exists (and is modified at or after since, if given) or the timeout expires
+        """
+
+        deadline = time.time() + timeout
+        wake_fd = Scheduler.get_wake_pipe()[0]
+        while True:
+            for trigger_filename in trigger_files:
+                if Scheduler.is_triggered(trigger_filename, since):
+                    return
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            fd = Scheduler.get_inotify()
+            watched = fd is not None
+            if watched is True:
+                for trigger_filename in trigger_files:
+                    directory = os.path.dirname(trigger_filename)
+                    if Scheduler.libc.inotify_add_watch(fd, directory, IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE) < 0:
+                        watched = False  # E.g. the mountpoint doesn't exist (yet), fall back to polling
+            if watched is False:
+                readable, _, _ = select.select([wake_fd], [], [], min(remaining, Scheduler.poll_interval))
+            else:
+                readable, _, _ = select.select([fd, wake_fd], [], [], remaining)
+            if fd in readable:
+                os.read(fd, 65536)  # The events are only used as wake-up, the trigger files are checked above
+            if wake_fd in readable:
+                os.read(wake_fd, 65536)
+                return
+
+    @staticmethod
+    def is_triggered(trigger_filename, since=None):
+        """
+        Checks whether a trigger file exists and is modified at or after since
+        """
+
+        try:
+            modified = os.path.getmtime(trigger_filename)
+        except OSError:
+            return False  # The file doesn't exist
+        # Whole seconds, as some filesystems don't store fractions
+        return since is None or modified >= int(since)
+
+    @staticmethod
+    def wake():
+        """
+        Interrupts the current (or next) wait, e.g. to handle a run requested over the control socket
+        """
+
+        os.write(Scheduler.get_wake_pipe()[1], 'x')
+
+    @staticmethod
+    def get_wake_pipe():
+        """
+        Returns the pipe used to interrupt a wait, creating it if needed
+        """
+
+        with Scheduler.wake_lock:
+            if Scheduler.wake_pipe is None:
+                Scheduler.wake_pipe = os.pipe()
+            return Scheduler.wake_pipe
+
+    @staticmethod
+    def get_inotify():
+        """
+        Returns the inotify file descriptor, or None if inotify is not available
+        """
+
+        if Scheduler.inotify is None:
+            Scheduler.inotify = False
+            try:
+                Scheduler.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                fd = Scheduler.libc.inotify_init()
+                if fd >= 0:
+                    Scheduler.inotify = fd
+            except (OSError, AttributeError) as ex:
+                Scheduler.logger.info('Inotify not available, polling for trigger files: {0}'.format(str(ex)))
+        if Scheduler.inotify is False:
+            return None
+        return Scheduler.inotify
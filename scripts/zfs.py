@@ -22,7 +22,14 @@
 Provides basic ZFS functionality
 """
 
-from helper import Helper
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from helper import Helper, SSH, MAX_ARGUMENT_LENGTH
 
 
 class ZFS(object):
@@ -33,41 +40,39 @@ class ZFS(object):
     logger = None  # The manager will fill this object
 
     @staticmethod
-    def get_snapshots(dataset='', endpoint=''):
+    def get_snapshots_many(datasets, endpoint='', recursive=False):
         """
-        Retreives a list of snapshots
+        Retreives the snapshots of the given datasets (and with recursive, of all their descendants), using a single listing
         """
 
+        endpoint = SSH.wrap(endpoint)
         if endpoint == '':
-            command = 'zfs list -H -s creation -t snapshot{0}{1} || true'
-        else:
-            command = '{0} \'zfs list -H -s creation -t snapshot{1} || true\''
-        if dataset == '':
-            dataset_filter = ''
+            command = 'zfs list -H -s createtxg -t snapshot -o name {2} {1} || true'
         else:
-            dataset_filter = ' | grep {0}@'.format(dataset)
-        output = Helper.run_command(command.format(endpoint, dataset_filter), '/')
+            command = '{0} \'zfs list -H -s createtxg -t snapshot -o name {2} {1} || true\''
         snapshots = {}
-        for line in filter(len, output.split('\n')):
-            parts = filter(len, line.split('\t'))
-            datasetname = parts[0].split('@')[0]
-            if datasetname not in snapshots:
-                snapshots[datasetname] = []
-            snapshots[datasetname].append(parts[0].split('@')[1])
+        for chunk in Helper.chunk(datasets):
+            ZFS.parse_snapshots(Helper.run_command_lines(command.format(endpoint, ' '.join(chunk), '-r' if recursive is True else '-d 1'), '/'), snapshots)
         return snapshots
 
     @staticmethod
-    def get_datasets():
+    def parse_snapshots(lines, snapshots=None):
         """
-        Retreives all datasets
+        Parses the lines of a zfs list output of snapshots into a list of snapshots per dataset
         """
 
-        output = Helper.run_command('zfs list -H', '/')
-        datasets = []
-        for line in filter(len, output.split('\n')):
-            parts = filter(len, line.split('\t'))
-            datasets.append(parts[0])
-        return datasets
+        if snapshots is None:
+            snapshots = {}
+        for line in lines:
+            name = line.split('\t', 1)[0]
+            if '@' not in name:
+                continue
+            datasetname, snapshot = name.split('@', 1)
+            dataset_snapshots = snapshots.get(datasetname)
+            if dataset_snapshots is None:
+                dataset_snapshots = snapshots[datasetname] = []
+            dataset_snapshots.append(snapshot)
+        return snapshots
 
     @staticmethod
     def snapshot(dataset, name, recursive):
@@ -77,17 +82,116 @@ class ZFS(object):
 
         command = 'zfs snapshot {2} {0}@{1}'.format(dataset, name, "-r" if recursive else "")
         Helper.run_command(command, '/')
+        Inventory.add(dataset, name, recursive)
 
     @staticmethod
-    def replicate(dataset, base_snapshot, last_snapshot, target, buffer_size, endpoint='', direction='push', compression=None):
+    def replicate(dataset, base_snapshot, last_snapshot, target, buffer_size, endpoint='', direction='push', compression=None, intermediates=False, resumable=False, send_flags='', recursive=False, rate_limit=None):
         """
         Replicates a dataset towards a given endpoint/target (push)
         Replicates a dataset from a given endpoint to a local target (pull)
+        With intermediates, all snapshots between base and last are sent in a single stream
+        When resumable, the target keeps the state of an interrupted transfer, and that transfer is resumed first
+        The send flags (e.g. -c -L -e -w) are passed to zfs send as is
+        With recursive, the dataset and all its descendants are sent in a single replication stream (which can't be resumed)
+        A rate limit (e.g. 10M, in bytes per second) throttles the stream towards a remote endpoint
+        """
+
+        if recursive is True:
+            send_flags = '-R {0}'.format(send_flags).strip()
+            resumable = False
+        resumed = False
+        if resumable is True:
+            token = ZFS.get_resume_token(target, endpoint if direction == 'push' else '')
+            if token is not None:
+                resumed_snapshot = ZFS.resume(token, target, buffer_size, endpoint, direction, compression, rate_limit)
+                if resumed_snapshot is not None:
+                    resumed = True
+                    base_snapshot = resumed_snapshot
+                    intermediates = intermediates and base_snapshot != last_snapshot
+
+        if base_snapshot != last_snapshot:
+            send = ZFS.get_send_command(dataset, base_snapshot, last_snapshot, intermediates, send_flags)
+            receive = 'zfs receive {0}-F {1}'.format('-s ' if resumable is True else '', target)
+            ZFS.transfer(send, receive, buffer_size, endpoint, direction, compression, rate_limit)
+
+        if endpoint == '' or direction == 'pull':
+            # The target is a local dataset
+            if intermediates is True or resumed is True:
+                Inventory.invalidate(target)
+            else:
+                Inventory.add(target, last_snapshot, recursive)
+
+    @staticmethod
+    def replicate_many(dataset, base_snapshot, last_snapshot, targets, buffer_size, intermediates=False, resumable=False, send_flags='', recursive=False, rate_limit=None):
+        """
+        Replicates a dataset towards several targets, given as (target, endpoint, compression), from a single send stream
+        Targets with an interrupted transfer are resumed and replicated on their own
+        When the shared stream fails as a whole (e.g. a target stopped reading and blocked the others until the stream got
+        killed), the targets that didn't finish are retried on their own, so only the blocking one fails
+        Returns the error message per target, None for the targets that succeeded
+        """
+
+        if recursive is True:
+            send_flags = '-R {0}'.format(send_flags).strip()
+            resumable = False
+        errors = [None] * len(targets)
+        shared = []
+        for index, (target, endpoint, compression) in enumerate(targets):
+            if resumable is True and ZFS.get_resume_token(target, endpoint) is not None:
+                try:
+                    ZFS.replicate(dataset, base_snapshot, last_snapshot, target, buffer_size, endpoint, 'push', compression,
+                                  intermediates, resumable, send_flags, rate_limit=rate_limit)
+                except RuntimeError as ex:
+                    errors[index] = str(ex)
+            else:
+                shared.append(index)
+        if not shared:
+            return errors
+
+        send = ZFS.get_send_command(dataset, base_snapshot, last_snapshot, intermediates, send_flags)
+        legs = []
+        for index in shared:
+            target, endpoint, compression = targets[index]
+            legs.append(('zfs receive {0}-F {1}'.format('-s ' if resumable is True else '', target), endpoint, compression))
+        leg_errors, interrupted = ZFS.transfer_many(send, legs, buffer_size, rate_limit)
+        for leg, (index, error) in enumerate(zip(shared, leg_errors)):
+            errors[index] = error
+            target, endpoint, compression = targets[index]
+            if leg in interrupted and len(shared) > 1:
+                ZFS.logger.info('  Retrying {0} on its own: {1}'.format(target, error))
+                try:
+                    ZFS.replicate(dataset, base_snapshot, last_snapshot, target, buffer_size, endpoint, 'push', compression,
+                                  intermediates, resumable, send_flags, rate_limit=rate_limit)
+                    errors[index] = None
+                except RuntimeError as ex:
+                    errors[index] = str(ex)
+                continue
+            if error is None and endpoint == '':
+                # The target is a local dataset
+                if intermediates is True:
+                    Inventory.invalidate(target)
+                else:
+                    Inventory.add(target, last_snapshot, recursive)
+        return errors
+
+    @staticmethod
+    def get_send_command(dataset, base_snapshot, last_snapshot, intermediates=False, send_flags=''):
+        """
+        Builds the zfs send command for a full (no base) or incremental stream
         """
 
         delta = ''
         if base_snapshot is not None:
-            delta = '-i {0}@{1} '.format(dataset, base_snapshot)
+            # A base starting with # is a bookmark
+            separator = '' if base_snapshot.startswith('#') else '@'
+            delta = '-{0} {1}{2}{3} '.format('I' if intermediates else 'i', dataset, separator, base_snapshot)
+        return 'zfs send {0}{1}{2}@{3}'.format(send_flags + ' ' if send_flags else '', delta, dataset, last_snapshot)
+
+    @staticmethod
+    def transfer(send, receive, buffer_size, endpoint='', direction='push', compression=None, rate_limit=None):
+        """
+        Pipes a send command into a receive command, over the endpoint if needed
+        """
 
         if compression is not None:
             compress = '| {0} -c'.format(compression)
@@ -95,71 +199,237 @@ class ZFS(object):
         else:
             compress = ''
             decompress = ''
+        # The sending side's buffer throttles the stream
+        limit = ' -r {0}'.format(rate_limit) if rate_limit is not None else ''
 
+        endpoint = SSH.wrap(endpoint)
         if endpoint == '':
-            # We're replicating to a local target
-            command = 'zfs send {0}{1}@{2} | zfs receive -F {3}'
-            command = command.format(delta, dataset, last_snapshot, target)
-            Helper.run_command(command, '/')
+            # We're replicating to a local target. The data passes through mbuffer, so a stalled stream can be noticed.
+            command = '{0} | mbuffer -q -v 0 -s 128k -m {1}{2} | {3}'.format(send, buffer_size, limit, receive)
+            Helper.run_command(command, '/', stream=True)
         else:
             if direction == 'push':
                 # We're replicating to a remote server
-                command = 'zfs send {0}{1}@{2} {3} | mbuffer -q -v 0 -s 128k -m {4} | {5} \'mbuffer -s 128k -m {4} {6} | zfs receive -F {7}\''
-                command = command.format(delta, dataset, last_snapshot, compress, buffer_size, endpoint, decompress, target)
-                Helper.run_command(command, '/')
+                command = '{0} {1} | mbuffer -q -v 0 -s 128k -m {2}{6} | {3} \'mbuffer -s 128k -m {2} {4} | {5}\''
+                command = command.format(send, compress, buffer_size, endpoint, decompress, receive, limit)
+                Helper.run_command(command, '/', stream=True)
             elif direction == 'pull':
                 # We're pulling from a remote server
-                command = '{5} \'zfs send {0}{1}@{2} {3} | mbuffer -q -v 0 -s 128k -m {4}\' | mbuffer -s 128k -m {4} {6} | zfs receive -F {7}'
-                command = command.format(delta, dataset, last_snapshot, compress, buffer_size, endpoint, decompress, target)
-                Helper.run_command(command, '/')
+                command = '{3} \'{0} {1} | mbuffer -q -v 0 -s 128k -m {2}{6}\' | mbuffer -s 128k -m {2} {4} | {5}'
+                command = command.format(send, compress, buffer_size, endpoint, decompress, receive, limit)
+                Helper.run_command(command, '/', stream=True)
 
     @staticmethod
-    def is_held(target, snapshot, endpoint=''):
+    def transfer_many(send, legs, buffer_size, rate_limit=None):
+        """
+        Pipes a send command into several receive commands, given as (receive, endpoint, compression). A single mbuffer
+        feeds a fifo per receiving leg. When a leg fails, mbuffer disables its output and the other legs continue.
+        Returns the error message per leg, None for the legs that succeeded, and the legs that were interrupted because
+        the shared stream failed
+        """
+
+        directory = tempfile.mkdtemp(prefix='zsm-')
+        try:
+            outputs = []
+            commands = []
+            for index, (receive, endpoint, compression) in enumerate(legs):
+                fifo = os.path.join(directory, str(index))
+                os.mkfifo(fifo, 0o600)
+                outputs.append('-o {0}'.format(fifo))
+                endpoint = SSH.wrap(endpoint)
+                if endpoint == '':
+                    command = '{0} < {1}'.format(receive, fifo)
+                elif compression is not None:
+                    command = '{0} -c < {1} | {2} \'mbuffer -s 128k -m {3} | {0} -cd | {4}\''
+                    command = command.format(compression, fifo, endpoint, buffer_size, receive)
+                else:
+                    command = '{0} \'mbuffer -s 128k -m {1} | {2}\' < {3}'.format(endpoint, buffer_size, receive, fifo)
+                commands.append('({0}; echo $? > {1}.status) 2> {1}.error &'.format(command, fifo))
+            limit = '-r {0} '.format(rate_limit) if rate_limit is not None else ''
+            command = '{0} | mbuffer -q -v 0 -s 128k -m {1} {2}{3} & {4} wait'.format(send, buffer_size, limit, ' '.join(outputs), ' '.join(commands))
+            stream_error = None
+            try:
+                Helper.run_command(command, '/', stream=True)
+            except RuntimeError as ex:
+                # The legs that didn't finish were killed along with the stream
+                stream_error = str(ex)
+            errors = []
+            interrupted = []
+            for index, (receive, endpoint, _) in enumerate(legs):
+                fifo = os.path.join(directory, str(index))
+                status = open(fifo + '.status').read().strip() if os.path.exists(fifo + '.status') else 'unknown'
+                if status == '0':
+                    errors.append(None)
+                elif stream_error is not None:
+                    errors.append(stream_error)
+                    interrupted.append(index)
+                else:
+                    errors.append('{0} failed with return value {1} and error message {2}'.format(
+                        receive if endpoint == '' else '{0} {1}'.format(endpoint, receive), status, open(fifo + '.error').read().strip()))
+            return errors, interrupted
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    @staticmethod
+    def get_resume_token(target, endpoint=''):
+        """
+        Retreives the token to resume an interrupted receive on the target, if any
+        """
+
+        endpoint = SSH.wrap(endpoint)
+        if endpoint == '':
+            command = 'zfs get -H -o value receive_resume_token {0} || true'.format(target)
+        else:
+            command = '{0} \'zfs get -H -o value receive_resume_token {1} || true\''.format(endpoint, target)
+        token = Helper.run_command(command, '/').strip()
+        if token in ('', '-'):
+            return None
+        return token
+
+    @staticmethod
+    def resume(token, target, buffer_size, endpoint='', direction='push', compression=None, rate_limit=None):
+        """
+        Resumes an interrupted transfer, returning the snapshot that is completed on the target. If the transfer
+        can't be resumed (e.g. the snapshot no longer exists), the partial state is discarded and None is returned.
+        """
+
+        send_endpoint = SSH.wrap(endpoint) if direction == 'pull' else ''
+        command = 'zfs send -nvP -t {0} 2>&1'.format(token)
+        if send_endpoint != '':
+            command = '{0} \'{1}\''.format(send_endpoint, command)
+        try:
+            output = Helper.run_command(command, '/')
+        except RuntimeError as ex:
+            ZFS.logger.info('  Discarding interrupted transfer towards {0}: {1}'.format(target, str(ex)))
+            receive_endpoint = SSH.wrap(endpoint) if direction == 'push' else ''
+            command = 'zfs receive -A {0}'.format(target)
+            if receive_endpoint != '':
+                command = '{0} \'{1}\''.format(receive_endpoint, command)
+            Helper.run_command(command, '/')
+            return None
+        snapshot = re.search(r'toname\s*=?\s*(\S+@\S+)', output)
+        transferred = re.search(r'\sbytes\s*=?\s*(0x[0-9a-fA-F]+|[0-9]+)', output)
+        remaining = re.search(r'^size\s+([0-9]+)', output, re.MULTILINE)
+        if snapshot is None:
+            raise RuntimeError('Could not parse resume token for {0}: {1}'.format(target, output))
+        ZFS.logger.info('  Resuming {0} > {1}, {2} bytes already transferred, {3} bytes remaining'.format(
+            snapshot.group(1), target,
+            int(transferred.group(1), 0) if transferred is not None else 'unknown',
+            remaining.group(1) if remaining is not None else 'unknown'))
+        ZFS.transfer('zfs send -t {0}'.format(token), 'zfs receive -s -F {0}'.format(target), buffer_size, endpoint, direction, compression,
+                     rate_limit)
+        return snapshot.group(1).split('@')[1]
+
+    @staticmethod
+    def get_held_snapshots(datasets, endpoint=''):
+        """
+        Retreives the snapshots held by zsm for the given datasets, per dataset. Only the snapshots that have
+        user references are queried for their holds, in as few commands as possible.
+        """
+
+        endpoint = SSH.wrap(endpoint)
         if endpoint == '':
-            command = 'zfs holds {0}@{1}'.format(target, snapshot)
-            return 'zsm' in Helper.run_command(command, '/')
-        command = '{0} \'zfs holds {1}@{2}\''.format(endpoint, target, snapshot)
-        return 'zsm' in Helper.run_command(command, '/')
+            command = '{0}'
+        else:
+            command = '{1} \'{0}\''
+        held_snapshots = dict((dataset, set()) for dataset in datasets)
+        if not datasets:
+            return held_snapshots
+        referenced = []
+        for dataset_chunk in Helper.chunk(datasets):
+            list_command = 'zfs list -H -t snapshot -o name,userrefs -d 1 {0} || true'.format(' '.join(dataset_chunk))
+            for line in Helper.run_command_lines(command.format(list_command, endpoint), '/'):
+                parts = line.split('\t')
+                if len(parts) == 2 and parts[1].strip() not in ('0', '-'):
+                    referenced.append(parts[0])
+        for snapshot_chunk in Helper.chunk(referenced):
+            holds_command = 'zfs holds -H {0} || true'.format(' '.join(snapshot_chunk))
+            for line in Helper.run_command_lines(command.format(holds_command, endpoint), '/'):
+                parts = line.split('\t')
+                if len(parts) >= 2 and (parts[1] == 'zsm' or parts[1].startswith('zsm_')):
+                    datasetname, snapshot = parts[0].split('@')
+                    held_snapshots.setdefault(datasetname, set()).add(snapshot)
+        return held_snapshots
 
     @staticmethod
-    def hold(target, snapshot, endpoint=''):
+    def hold(target, snapshot, endpoint='', recursive=False, tag='zsm'):
+        endpoint = SSH.wrap(endpoint)
+        flags = '-r ' if recursive is True else ''
         if endpoint == '':
-            command = 'zfs hold zsm {0}@{1}'.format(target, snapshot)
+            command = 'zfs hold {0}{1} {2}@{3}'.format(flags, tag, target, snapshot)
             Helper.run_command(command, '/')
         else:
-            command = '{0} \'zfs hold zsm {1}@{2}\''.format(endpoint, target, snapshot)
+            command = '{0} \'zfs hold {1}{2} {3}@{4}\''.format(endpoint, flags, tag, target, snapshot)
             Helper.run_command(command, '/')
 
     @staticmethod
-    def release(target, snapshot, endpoint=''):
+    def release(target, snapshot, endpoint='', recursive=False, tag='zsm'):
+        endpoint = SSH.wrap(endpoint)
+        flags = '-r ' if recursive is True else ''
         if endpoint == '':
-            command = 'zfs release zsm {0}@{1} || true'.format(target, snapshot)
+            command = 'zfs release {0}{1} {2}@{3} || true'.format(flags, tag, target, snapshot)
             Helper.run_command(command, '/')
         else:
-            command = '{0} \'zfs release zsm {1}@{2} || true\''.format(endpoint, target, snapshot)
+            command = '{0} \'zfs release {1}{2} {3}@{4} || true\''.format(endpoint, flags, tag, target, snapshot)
             Helper.run_command(command, '/')
 
     @staticmethod
-    def get_size(dataset, base_snapshot, last_snapshot, endpoint=''):
+    def bookmark(dataset, snapshot, tag, base_snapshot=None):
         """
-        Executes a dry-run zfs send to calculate the size of the delta.
+        Bookmarks a replicated snapshot (as #tag.snapshot), so it can serve as incremental source even after the
+        snapshot itself is cleaned. The bookmark of the base snapshot is destroyed and its hold (if any, from before
+        bookmarks were used) is released in the same command.
         """
-        delta = ''
+
+        name = '{0}#{1}.{2}'.format(dataset, tag, snapshot)
+        command = '(zfs list -H -o name {0} > /dev/null 2>&1 || zfs bookmark {1}@{2} {0})'.format(name, dataset, snapshot)
         if base_snapshot is not None:
-            delta = '-i {0}@{1} '.format(dataset, base_snapshot)
+            command += ' && {{ zfs destroy {0}#{1}.{2} 2> /dev/null; zfs release {1} {0}@{2} 2> /dev/null; true; }}'.format(
+                dataset, tag, base_snapshot)
+        Helper.run_command(command, '/')
 
-        if endpoint == '':
-            command = 'zfs send -nv {0}{1}@{2}'
-            command = command.format(delta, dataset, last_snapshot)
-        else:
-            command = '{0} \'zfs send -nv {1}{2}@{3}\''
-            command = command.format(endpoint, delta, dataset, last_snapshot)
-        command = '{0} 2>&1 | grep \'total estimated size is\''.format(command)
-        output = Helper.run_command(command, '/')
-        size = output.strip().split(' ')[-1]
-        if size[-1].isdigit():
-            return '{0}B'.format(size)
-        return '{0}iB'.format(size)
+    @staticmethod
+    def get_history(dataset):
+        """
+        Lists the snapshots (as @snapshot) and bookmarks (as #bookmark) of a dataset, in the order of creation
+        """
+
+        command = 'zfs list -H -t snapshot,bookmark -o name -s createtxg -d 1 {0}'.format(dataset)
+        history = []
+        for line in Helper.run_command_lines(command, '/'):
+            name = line.strip()
+            if name.startswith(dataset + '@') or name.startswith(dataset + '#'):
+                history.append(name[len(dataset):])
+        return history
+
+    @staticmethod
+    def get_sizes(dataset, base_snapshot, last_snapshot, endpoint='', intermediates=False, send_flags='', recursive=False):
+        """
+        Executes a single parsable dry-run zfs send (using the same send flags as the transfer) to calculate the exact
+        size of a stream. Returns the total number of bytes (None if the output couldn't be parsed), and the number of
+        bytes per snapshot in the stream.
+        """
+
+        if recursive is True:
+            send_flags = '-R {0}'.format(send_flags).strip()
+        command = ZFS.get_send_command(dataset, base_snapshot, last_snapshot, intermediates, send_flags)
+        command = '{0} 2>&1'.format(command.replace('zfs send', 'zfs send -nvP', 1))
+        endpoint = SSH.wrap(endpoint)
+        if endpoint != '':
+            command = '{0} \'{1}\''.format(endpoint, command)
+        total = None
+        sizes = {}
+        for line in Helper.run_command_lines(command, '/'):
+            parts = line.split('\t')
+            if parts[0] in ('full', 'incremental') and len(parts) >= 3 and parts[-1].isdigit():
+                # With recursive, every dataset in the tree has its own line per snapshot
+                snapshot = parts[-2].split('@')[-1]
+                sizes[snapshot] = sizes.get(snapshot, 0) + int(parts[-1])
+            elif parts[0] == 'size' and len(parts) == 2 and parts[1].isdigit():
+                total = int(parts[1])
+        if total is None and sizes:
+            total = sum(sizes.values())
+        return total, sizes
 
     @staticmethod
     def destroy(dataset, snapshot, recursive):
@@ -169,3 +439,178 @@ class ZFS(object):
 
         command = 'zfs destroy {2} {0}@{1}'.format(dataset, snapshot, "-r" if recursive else "")
         Helper.run_command(command, '/')
+        Inventory.remove(dataset, [snapshot], recursive)
+
+    @staticmethod
+    def destroy_many(dataset, snapshots, recursive):
+        """
+        Destroyes multiple snapshots of a dataset using as few commands as possible. If a batch fails, its
+        snapshots are destroyed one by one so a single failing snapshot doesn't block the others.
+        """
+
+        destroyed = []
+        for chunk in Helper.chunk(snapshots, MAX_ARGUMENT_LENGTH - len(dataset)):
+            command = 'zfs destroy {2} {0}@{1}'.format(dataset, ','.join(chunk), '-r' if recursive else '')
+            try:
+                Helper.run_command(command, '/')
+                destroyed += chunk
+            except RuntimeError as ex:
+                ZFS.logger.error('Batch destroy failed, destroying one by one: {0}'.format(str(ex)))
+                for snapshot in chunk:
+                    try:
+                        ZFS.destroy(dataset, snapshot, recursive)
+                        destroyed.append(snapshot)
+                    except RuntimeError as ex:
+                        ZFS.logger.error('  Could not destroy {0}@{1}: {2}'.format(dataset, snapshot, str(ex)))
+        Inventory.remove(dataset, destroyed, recursive)
+        return destroyed
+
+    @staticmethod
+    def destroy_remote(targets, endpoint=''):
+        """
+        Destroys snapshots of multiple datasets (given as dataset, snapshots, recursive) on an endpoint, using a single
+        command unless it gets too long. A batch that fails is retried one snapshot at a time within the same command.
+        Returns the destroyed snapshots per dataset.
+        """
+
+        parts = []
+        for dataset, snapshots, recursive in targets:
+            flags = '-r ' if recursive is True else ''
+            # Every snapshot appears twice in a part, in the batch and in the retry loop
+            for chunk in Helper.chunk(snapshots, MAX_ARGUMENT_LENGTH / 2 - len(dataset)):
+                parts.append('zfs destroy {0}{1}@{2} 2> /dev/null || for snapshot in {3}; do '
+                             'zfs destroy {0}{1}@$snapshot 2> /dev/null || echo {1}@$snapshot; done'.format(
+                                 flags, dataset, ','.join(chunk), ' '.join(chunk)))
+        endpoint = SSH.wrap(endpoint)
+        failed = set()
+        for chunk in Helper.chunk(parts):
+            command = '; '.join(chunk)
+            if endpoint != '':
+                command = '{0} \'{1}\''.format(endpoint, command)
+            for line in Helper.run_command_lines(command, '/'):
+                failed.add(line.strip())
+        destroyed = {}
+        for dataset, snapshots, recursive in targets:
+            destroyed[dataset] = [snapshot for snapshot in snapshots if '{0}@{1}'.format(dataset, snapshot) not in failed]
+            if endpoint == '':
+                Inventory.remove(dataset, destroyed[dataset], recursive)
+        return destroyed
+
+
+class Inventory(object):
+    """
+    Caches the datasets and snapshots of the managed datasets. The ZFS operations of the daemon itself update the
+    cache directly. A dataset is listed again when its snapshots_changed property changes, and all datasets are
+    listed again after a configurable interval.
+    """
+
+    interval = 3600  # Seconds between full rescans, 0 rescans on every load
+    lock = threading.RLock()
+    snapshots = {}  # Snapshots per dataset, in creation order
+    stamps = {}  # Last seen snapshots_changed value per dataset
+    invalid = set()  # Datasets that need to be listed again
+    touched = set()  # Datasets changed by the daemon itself since the last load
+    datasets = None  # The datasets for which the cache was built
+    last_scan = 0
+
+    @staticmethod
+    def load(datasets):
+        """
+        Returns the existing datasets among the given ones, and their snapshots
+        """
+
+        datasets = sorted(datasets)
+        with Inventory.lock:
+            if Inventory.datasets != datasets or Inventory.interval == 0 or time.time() - Inventory.last_scan > Inventory.interval:
+                Inventory.datasets = datasets
+                Inventory.snapshots = {}
+                Inventory.invalid = set()
+                Inventory.touched = set()
+                Inventory.scan(datasets)
+                Inventory.stamps = Inventory.get_stamps(Inventory.snapshots.keys())
+                Inventory.last_scan = time.time()
+            else:
+                stamps = Inventory.get_stamps(Inventory.snapshots.keys())
+                if stamps:  # Empty when the snapshots_changed property is not supported
+                    for dataset in Inventory.snapshots:
+                        if dataset not in Inventory.touched and stamps.get(dataset) != Inventory.stamps.get(dataset):
+                            Inventory.invalid.add(dataset)
+                    Inventory.stamps = stamps
+                Inventory.touched = set()
+                if Inventory.invalid:
+                    invalid = sorted(Inventory.invalid)
+                    for dataset in invalid:
+                        Inventory.snapshots.pop(dataset, None)
+                    Inventory.invalid = set()
+                    Inventory.scan(invalid)
+            found = [dataset for dataset in datasets if dataset in Inventory.snapshots]
+            return found, dict((dataset, list(Inventory.snapshots[dataset])) for dataset in found)
+
+    @staticmethod
+    def scan(datasets):
+        """
+        Lists the given datasets and their snapshots, sorted by creation
+        """
+
+        wanted = set(datasets)
+        for chunk in Helper.chunk(datasets):
+            command = 'zfs list -H -t filesystem,volume,snapshot -o name -s createtxg -d 1 {0} || true'.format(' '.join(chunk))
+            for line in Helper.run_command_lines(command, '/'):
+                name = line.strip()
+                if '@' in name:
+                    dataset, snapshot = name.split('@')
+                    if dataset in wanted:
+                        Inventory.snapshots.setdefault(dataset, []).append(snapshot)
+                elif name in wanted:
+                    Inventory.snapshots.setdefault(name, [])
+
+    @staticmethod
+    def get_stamps(datasets):
+        """
+        Retreives the snapshots_changed property of the given datasets. Returns an empty dict if the property is
+        not supported by the installed ZFS version.
+        """
+
+        stamps = {}
+        for chunk in Helper.chunk(sorted(datasets)):
+            command = 'zfs get -H -p -o name,value snapshots_changed {0} 2>/dev/null || true'.format(' '.join(chunk))
+            for line in Helper.run_command_lines(command, '/'):
+                parts = line.split('\t')
+                if len(parts) == 2:
+                    stamps[parts[0]] = parts[1]
+        return stamps
+
+    @staticmethod
+    def add(dataset, snapshot, recursive):
+        """
+        Registers a snapshot taken or received by the daemon
+        """
+
+        with Inventory.lock:
+            for name in Inventory.snapshots:
+                if name == dataset or (recursive is True and name.startswith(dataset + '/')):
+                    if snapshot not in Inventory.snapshots[name]:
+                        Inventory.snapshots[name].append(snapshot)
+                    Inventory.touched.add(name)
+
+    @staticmethod
+    def remove(dataset, snapshots, recursive):
+        """
+        Unregisters snapshots destroyed by the daemon
+        """
+
+        snapshots = set(snapshots)
+        with Inventory.lock:
+            for name in Inventory.snapshots:
+                if name == dataset or (recursive is True and name.startswith(dataset + '/')):
+                    Inventory.snapshots[name] = [snapshot for snapshot in Inventory.snapshots[name] if snapshot not in snapshots]
+                    Inventory.touched.add(name)
+
+    @staticmethod
+    def invalidate(dataset):
+        """
+        Makes sure a dataset is listed again on the next load
+        """
+
+        with Inventory.lock:
+            Inventory.invalid.add(dataset)
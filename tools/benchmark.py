@@ -0,0 +1,474 @@
+# Copyright (c) 2014 Kenneth Henderick <kenneth@ketronic.be>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Benchmarks the manager against fake zfs, ssh and mbuffer executables (see fakezfs.py)
+* No ZFS pools or remote hosts are needed, the fakes simulate the inventory, latencies and throughput
+* Reports wall time, commands started through Helper, zfs calls, ssh sessions and bytes moved per scenario
+* The call volumes and bytes are compared against benchmark_baseline.json, use --check to fail on regressions
+* Every scenario also verifies the resulting snapshots on the fake hosts, so an optimization can't skip work unnoticed
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+this_directory = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(this_directory, '..', 'scripts'))
+
+from manager import Manager
+from zfs import ZFS, Inventory
+from clean import Cleaner
+from helper import Helper, SSH, Watchdog
+from scheduler import Scheduler
+from compression import Compression
+from metrics import Metrics
+from journal import Journal
+
+BASELINE_FILENAME = os.path.join(this_directory, 'benchmark_baseline.json')
+CHECKED_METRICS = ['commands', 'zfs_calls', 'ssh_sessions', 'bytes']
+METRICS = ['wall', 'commands', 'zfs_calls', 'ssh_calls', 'ssh_sessions', 'bytes']
+
+
+def snapshot_name(days_ago):
+    day = datetime.now() - timedelta(days_ago)
+    return '{0:04d}{1:02d}{2:02d}'.format(day.year, day.month, day.day)
+
+
+def build_dataset(state, host, dataset, names, held=(), size=1048576):
+    """
+    Adds a dataset with the given snapshots (oldest first) to the fake state
+    """
+
+    datasets = state['hosts'].setdefault(host, {})
+    state['txg'] += 1
+    datasets[dataset] = {'type': 'filesystem', 'txg': state['txg'], 'snapshots': [], 'changed': state['txg']}
+    for name in names:
+        state['txg'] += 1
+        datasets[dataset]['snapshots'].append({'name': name, 'txg': state['txg'], 'size': size,
+                                               'holds': ['zsm'] if name in held else []})
+
+
+def scenario_idle(state):
+    """
+    Steady-state poll: 50 datasets with a year of dailies, nothing is due
+    """
+
+    config = '[zfs-snap-manager]\n'
+    for index in range(50):
+        dataset = 'tank/data{0:02d}'.format(index)
+        names = [snapshot_name(day) for day in range(364, -1, -1)]
+        build_dataset(state, 'localhost', dataset, names, held=names[-1:])
+        expect(state, 'localhost', dataset, names)
+        config += '[{0}]\nmountpoint = /mnt/{0}\ntime = 00:00\nsnapshot = True\nschema = 365d0w0m0y\n'.format(dataset)
+    return config, 1
+
+
+def scenario_catchup(state, single_stream=False):
+    """
+    A pushed dataset of which the target is 60 daily snapshots behind
+    """
+
+    names = [snapshot_name(day) for day in range(60, 0, -1)]
+    build_dataset(state, 'localhost', 'tank/data', names, held=names[:1])
+    build_dataset(state, 'backup', 'backup/data', names[:1], held=names[:1])
+    expect(state, 'backup', 'backup/data', names + [snapshot_name(0)])
+    config = ('[tank/data]\nmountpoint = /mnt/data\ntime = 00:00\nsnapshot = True\nschema = 365d0w0m0y\n'
+              'replicate_endpoint = ssh backup\nreplicate_target = backup/data\nsingle_stream = {0}\n').format(single_stream)
+    return config, 0
+
+
+def scenario_catchup_single(state):
+    """
+    The catch-up scenario, using a single stream
+    """
+
+    return scenario_catchup(state, single_stream=True)
+
+
+def scenario_prune(state):
+    """
+    Mass prune: three years of dailies cleaned with a 7d3w11m1y schema
+    """
+
+    names = [snapshot_name(day) for day in range(3 * 365, -1, -1)]
+    build_dataset(state, 'localhost', 'tank/data', names)
+    expect(state, 'localhost', 'tank/data', 7 + 3 + 11 + 1)  # Every bucket keeps a single snapshot
+    config = '[tank/data]\nmountpoint = /mnt/data\ntime = 00:00\nsnapshot = True\nschema = 7d3w11m1y\n'
+    return config, 0
+
+
+def scenario_fullsend(state):
+    """
+    Initial full send of a dataset towards a target that doesn't exist yet
+    """
+
+    names = [snapshot_name(day) for day in range(10, 0, -1)]
+    build_dataset(state, 'localhost', 'tank/data', names, size=8 * 1024 * 1024)
+    state['hosts']['backup'] = {}
+    expect(state, 'backup', 'backup/data', [snapshot_name(0)])  # Only the most recent snapshot is sent in full
+    config = ('[tank/data]\nmountpoint = /mnt/data\ntime = 00:00\nsnapshot = True\nschema = 365d0w0m0y\n'
+              'replicate_endpoint = ssh backup\nreplicate_target = backup/data\n')
+    return config, 0
+
+
+def scenario_tree(state):
+    """
+    A recursive dataset with 50 children, of which the target tree is 5 daily snapshots behind
+    """
+
+    names = [snapshot_name(day) for day in range(10, 0, -1)]
+    for host, root, count in [('localhost', 'tank/tree', 10), ('backup', 'backup/tree', 5)]:
+        build_dataset(state, host, root, names[:count], held=names[4:5])
+        for index in range(50):
+            build_dataset(state, host, '{0}/child{1:02d}'.format(root, index), names[:count], held=names[4:5])
+    for index in range(50):
+        expect(state, 'backup', 'backup/tree/child{0:02d}'.format(index), names + [snapshot_name(0)])
+    expect(state, 'backup', 'backup/tree', names + [snapshot_name(0)])
+    config = ('[tank/tree]\nmountpoint = /mnt/tree\ntime = 00:00\nsnapshot = True\nschema = 365d0w0m0y\nrecursive = True\n'
+              'replicate_recursive = True\nreplicate_endpoint = ssh backup\nreplicate_target = backup/tree\n')
+    return config, 0
+
+
+def scenario_fanout(state):
+    """
+    A dataset pushed to a remote and a local target, which are both 3 daily snapshots behind
+    """
+
+    names = [snapshot_name(day) for day in range(10, 0, -1)]
+    build_dataset(state, 'localhost', 'tank/data', names, size=4 * 1024 * 1024)
+    for entry in state['hosts']['localhost']['tank/data']['snapshots'][6:7]:
+        entry['holds'] = ['zsm', 'zsm_local']
+    build_dataset(state, 'backup', 'backup/data', names[:7], held=names[6:7])
+    build_dataset(state, 'localhost', 'spare/data', names[:7], held=names[6:7])
+    expect(state, 'backup', 'backup/data', names + [snapshot_name(0)])
+    expect(state, 'localhost', 'spare/data', names + [snapshot_name(0)])
+    config = ('[tank/data]\nmountpoint = /mnt/data\ntime = 00:00\nsnapshot = True\nschema = 365d0w0m0y\n'
+              'replicate_endpoint = ssh backup\nreplicate_target = backup/data\n'
+              'replicate_endpoint_local = \nreplicate_target_local = spare/data\n')
+    return config, 0
+
+
+def scenario_fullsend_compressed(state):
+    """
+    The full send scenario, sending the blocks compressed (2x compression ratio)
+    """
+
+    config, warmup_runs = scenario_fullsend(state)
+    state['config']['compressratio'] = 2
+    return config + 'send_compressed = True\n', warmup_runs
+
+
+def scenario_daily(state):
+    """
+    The daily run of a pushed dataset that is up to date, of which the journal knows the replicated snapshot
+    """
+
+    names = [snapshot_name(day) for day in range(30, 0, -1)]
+    build_dataset(state, 'localhost', 'tank/data', names, held=names[-1:])
+    build_dataset(state, 'backup', 'backup/data', names, held=names[-1:])
+    state['journal'] = [('tank/data', 'ssh backup:backup/data', names[-1])]
+    expect(state, 'backup', 'backup/data', names + [snapshot_name(0)])
+    config = ('[tank/data]\nmountpoint = /mnt/data\ntime = 00:00\nsnapshot = True\nschema = 365d0w0m0y\n'
+              'replicate_endpoint = ssh backup\nreplicate_target = backup/data\n')
+    return config, 0
+
+
+def scenario_queue(state):
+    """
+    Three pushed datasets sharing an endpoint: a small and a prioritized backlog are sent, a large backlog is
+    deferred to a window that is closed
+    """
+
+    names = [snapshot_name(day) for day in range(30, 0, -1)]
+    config = '[zfs-snap-manager]\nreplicate_window = {0:%H:%M}-{1:%H:%M}\nreplicate_window_size = 64\n'.format(
+        datetime.now() + timedelta(hours=2), datetime.now() + timedelta(hours=3))
+    for dataset, behind, size, priority in [('large', 20, 8 * 1024 * 1024, 0), ('small', 1, 1048576, 0), ('urgent', 5, 4 * 1048576, 1)]:
+        build_dataset(state, 'localhost', 'tank/' + dataset, names, held=names[-behind - 1:-behind], size=size)
+        build_dataset(state, 'backup', 'backup/' + dataset, names[:-behind], held=names[-behind - 1:-behind])
+        expect(state, 'backup', 'backup/' + dataset, names[:-behind] if dataset == 'large' else names + [snapshot_name(0)])
+        config += ('[tank/{0}]\nmountpoint = /mnt/{0}\ntime = 00:00\nsnapshot = True\nschema = 365d0w0m0y\npriority = {1}\n'
+                   'replicate_endpoint = ssh backup\nreplicate_target = backup/{0}\nsingle_stream = True\n').format(dataset, priority)
+    return config, 0
+
+
+def scenario_bookmarks(state):
+    """
+    A pushed dataset using bookmarks, of which the target was offline for 10 days: the last replicated snapshot was
+    cleaned on the source already, only its bookmark is left
+    """
+
+    names = [snapshot_name(day) for day in range(30, 0, -1)]
+    build_dataset(state, 'localhost', 'tank/data', names[:15] + names[20:])
+    build_dataset(state, 'backup', 'backup/data', names[:20], held=names[19:20])
+    snapshots = state['hosts']['localhost']['tank/data']['snapshots']
+    state['hosts']['localhost']['tank/data']['bookmarks'] = [{'name': 'zsm.' + names[19], 'txg': snapshots[14]['txg'] + 1, 'snapshot': names[19]}]
+    for entry in snapshots[15:]:
+        entry['txg'] += 1
+    state['txg'] += 1
+    expect(state, 'backup', 'backup/data', names + [snapshot_name(0)])
+    config = ('[tank/data]\nmountpoint = /mnt/data\ntime = 00:00\nsnapshot = True\nschema = 365d0w0m0y\n'
+              'replicate_endpoint = ssh backup\nreplicate_target = backup/data\nsingle_stream = True\nbookmarks = True\n')
+    return config, 0
+
+
+def scenario_stalled(state):
+    """
+    Two pushed datasets, of which the remote target stalls. The stalled stream is killed, the local target is still
+    replicated.
+    """
+
+    names = [snapshot_name(day) for day in range(10, 0, -1)]
+    build_dataset(state, 'localhost', 'tank/data', names, held=names[-1:])
+    build_dataset(state, 'backup', 'backup/data', names, held=names[-1:])
+    build_dataset(state, 'localhost', 'tank/local', names, held=names[-1:])
+    build_dataset(state, 'localhost', 'spare/local', names, held=names[-1:])
+    state['config']['stalled_hosts'] = ['backup']
+    expect(state, 'backup', 'backup/data', names)
+    expect(state, 'localhost', 'spare/local', names + [snapshot_name(0)])
+    config = ('[zfs-snap-manager]\nstall_timeout = 2\n'
+              '[tank/data]\nmountpoint = /mnt/data\ntime = 00:00\nsnapshot = True\nschema = 365d0w0m0y\n'
+              'replicate_endpoint = ssh backup\nreplicate_target = backup/data\n'
+              '[tank/local]\nmountpoint = /mnt/local\ntime = 00:00\nsnapshot = True\nschema = 365d0w0m0y\n'
+              'replicate_endpoint = \nreplicate_target = spare/local\n')
+    return config, 0
+
+
+def scenario_remoteclean(state):
+    """
+    The daily run of 10 pushed datasets of which the targets are cleaned with their own schema, on a single endpoint.
+    One of the expired snapshots has a foreign hold.
+    """
+
+    names = [snapshot_name(day) for day in range(60, 0, -1)]
+    config = ''
+    for index in range(10):
+        build_dataset(state, 'localhost', 'tank/data{0:02d}'.format(index), names, held=names[-1:])
+        build_dataset(state, 'backup', 'backup/data{0:02d}'.format(index), names, held=names[-1:])
+        config += ('[tank/data{0:02d}]\nmountpoint = /mnt/data{0:02d}\ntime = 00:00\nsnapshot = True\nschema = 365d0w0m0y\n'
+                   'remote_schema = 7d3w0m0y\nreplicate_endpoint = ssh backup\nreplicate_target = backup/data{0:02d}\n').format(index)
+    state['hosts']['backup']['backup/data00']['snapshots'][0]['holds'] = ['keep']  # Not ours, so left alone
+    for index in range(1, 10):
+        expect(state, 'backup', 'backup/data{0:02d}'.format(index), 7 + 3)
+    expect(state, 'backup', 'backup/data00', 7 + 3 + 1)
+    return config, 0
+
+
+SCENARIOS = [('idle', scenario_idle),
+             ('catchup', scenario_catchup),
+             ('catchup-single', scenario_catchup_single),
+             ('prune', scenario_prune),
+             ('fullsend', scenario_fullsend),
+             ('fullsend-compressed', scenario_fullsend_compressed),
+             ('tree', scenario_tree),
+             ('fanout', scenario_fanout),
+             ('daily', scenario_daily),
+             ('queue', scenario_queue),
+             ('bookmarks', scenario_bookmarks),
+             ('stalled', scenario_stalled),
+             ('remoteclean', scenario_remoteclean)]
+
+
+def expect(state, host, dataset, snapshots):
+    """
+    Registers the snapshots (a list of names, or their number) a dataset must have after the scenario's run
+    """
+
+    state.setdefault('expected', {}).setdefault(host, {})[dataset] = snapshots
+
+
+def verify(state_filename, expected):
+    """
+    Compares the snapshots on the fake hosts after a run with the expected ones, returning the differences
+    """
+
+    with open(state_filename) as state_file:
+        hosts = json.load(state_file)['hosts']
+    differences = []
+    for host in sorted(expected):
+        for dataset in sorted(expected[host]):
+            snapshots = expected[host][dataset]
+            actual = [entry['name'] for entry in hosts.get(host, {}).get(dataset, {}).get('snapshots', [])]
+            if isinstance(snapshots, int):
+                if len(actual) != snapshots:
+                    differences.append('{0}:{1} has {2} snapshots instead of {3}'.format(host, dataset, len(actual), snapshots))
+            elif actual != snapshots:
+                missing = [snapshot for snapshot in snapshots if snapshot not in actual]
+                extra = [snapshot for snapshot in actual if snapshot not in snapshots]
+                differences.append('{0}:{1} is missing {2} and has {3} extra'.format(
+                    host, dataset, ','.join(missing) or 'nothing', ','.join(extra) or 'nothing'))
+    return differences
+
+
+def run_scenario(name, builder, options):
+    """
+    Runs a single scenario in a temporary directory, returning its metrics and the differences with the expected state
+    """
+
+    directory = tempfile.mkdtemp(prefix='zsm-benchmark-')
+    try:
+        state = {'txg': 1, 'hosts': {}, 'config': {'throughput': options.throughput,
+                                                    'snapshots_changed': True}}
+        config, warmup_runs = builder(state)
+        journal = state.pop('journal', [])
+        expected = state.pop('expected', {})
+        state_filename = os.path.join(directory, 'state.json')
+        log_filename = os.path.join(directory, 'calls.log')
+        config_filename = os.path.join(directory, 'zfssnapmanager.cfg')
+        with open(state_filename, 'w') as state_file:
+            json.dump(state, state_file)
+        with open(config_filename, 'w') as config_file:
+            config_file.write(config)
+        bin_directory = os.path.join(directory, 'bin')
+        os.mkdir(bin_directory)
+        for tool in ['zfs', 'ssh', 'mbuffer']:
+            filename = os.path.join(bin_directory, tool)
+            with open(filename, 'w') as wrapper:
+                wrapper.write('#!/bin/sh\nexec {0} {1} {2} "$@"\n'.format(sys.executable, os.path.join(this_directory, 'fakezfs.py'), tool))
+            os.chmod(filename, 0o755)
+
+        os.environ['PATH'] = bin_directory + os.pathsep + options.original_path
+        os.environ['FAKE_ZFS_STATE'] = state_filename
+        os.environ['FAKE_ZFS_LOG'] = log_filename
+        os.environ['FAKE_ZFS_LATENCY'] = str(options.zfs_latency)
+        os.environ['FAKE_SSH_LATENCY'] = str(options.ssh_latency)
+
+        settings, global_settings = Manager.load_config(config_filename)
+        global_settings['journal_file'] = os.path.join(directory, 'journal.db')
+        Manager.configure(global_settings)
+        for dataset, target, snapshot in journal:
+            Journal.finish_transfer(dataset, target, snapshot)
+            Journal.record_hold(dataset, target, snapshot)
+        SSH.control_directory = os.path.join(directory, 'ssh')
+        Inventory.datasets = None
+        Manager.semaphores = {}
+        Compression.endpoints = {}
+        Metrics.throughputs = {}
+
+        for _ in range(warmup_runs):
+            Manager.run(settings, global_settings)
+        open(log_filename, 'w').close()
+
+        commands = [0]
+        original_run_command = Helper.run_command
+        original_run_command_lines = Helper.run_command_lines
+
+        def counting_run_command(command, cwd, **options):
+            commands[0] += 1
+            return original_run_command(command, cwd, **options)
+
+        def counting_run_command_lines(command, cwd):
+            commands[0] += 1
+            return original_run_command_lines(command, cwd)
+
+        Helper.run_command = staticmethod(counting_run_command)
+        Helper.run_command_lines = staticmethod(counting_run_command_lines)
+        try:
+            start = time.time()
+            Manager.run(settings, global_settings)
+            wall = time.time() - start
+        finally:
+            Helper.run_command = staticmethod(original_run_command)
+            Helper.run_command_lines = staticmethod(original_run_command_lines)
+
+        metrics = {'wall': round(wall, 3), 'commands': commands[0], 'zfs_calls': 0, 'ssh_calls': 0, 'ssh_sessions': 0, 'bytes': 0}
+        with open(log_filename) as log_file:
+            for line in log_file:
+                entry = json.loads(line)
+                if entry['tool'] == 'zfs':
+                    metrics['zfs_calls'] += 1
+                    if entry.get('kind') == 'send':
+                        metrics['bytes'] += entry['bytes']
+                elif entry['tool'] == 'ssh':
+                    metrics['ssh_calls'] += 1
+                    if entry['new_session'] is True:
+                        metrics['ssh_sessions'] += 1
+        return metrics, verify(state_filename, expected)
+    finally:
+        Journal.open('')
+        os.environ['PATH'] = options.original_path
+        if options.keep is True:
+            print 'Kept {0} in {1}'.format(name, directory)
+        else:
+            shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the manager against fake zfs, ssh and mbuffer executables')
+    parser.add_argument('scenarios', nargs='*', help='Scenarios to run (default: all)')
+    parser.add_argument('--check', action='store_true', help='Fail when call volumes or bytes exceed the baseline, or the '
+                                                             'resulting snapshots are wrong')
+    parser.add_argument('--update', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--zfs-latency', type=float, default=0.005, help='Simulated seconds per zfs call')
+    parser.add_argument('--ssh-latency', type=float, default=0.05, help='Simulated seconds per ssh handshake')
+    parser.add_argument('--throughput', type=float, default=400 * 1024 * 1024, help='Simulated send throughput (bytes/s)')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary directories')
+    parser.add_argument('--verbose', action='store_true', help='Show the manager log')
+    options = parser.parse_args()
+    options.original_path = os.environ.get('PATH', '')
+    Watchdog.interval = 0.5  # Stalled streams are detected within the scenario's short stall timeout
+
+    logger = logging.getLogger('benchmark')
+    logger.addHandler(logging.StreamHandler() if options.verbose else logging.NullHandler())
+    logger.setLevel(logging.INFO)
+    Manager.logger = logger
+    Cleaner.logger = logger
+    ZFS.logger = logger
+    Scheduler.logger = logger
+    Compression.logger = logger
+
+    baseline = {}
+    if os.path.exists(BASELINE_FILENAME):
+        with open(BASELINE_FILENAME) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    regressions = []
+    print '{0:<20}'.format('scenario') + ''.join('{0:>14}'.format(metric) for metric in METRICS)
+    for name, builder in SCENARIOS:
+        if options.scenarios and name not in options.scenarios:
+            continue
+        metrics, differences = run_scenario(name, builder, options)
+        results[name] = metrics
+        print '{0:<20}'.format(name) + ''.join('{0:>14}'.format(metrics[metric]) for metric in METRICS)
+        regressions.extend('{0}: {1}'.format(name, difference) for difference in differences)
+        for metric in CHECKED_METRICS:
+            if name in baseline and metrics[metric] > baseline[name][metric]:
+                regressions.append('{0}: {1} went from {2} to {3}'.format(name, metric, baseline[name][metric], metrics[metric]))
+
+    for regression in regressions:
+        print 'Regression: {0}'.format(regression)
+    if options.update is True:
+        baseline.update(results)
+        with open(BASELINE_FILENAME, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=4, sort_keys=True, separators=(',', ': '))
+            baseline_file.write('\n')
+    if options.check is True and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
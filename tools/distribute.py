@@ -35,7 +35,7 @@ if __name__ == '__main__':
     this_directory = os.path.dirname(os.path.abspath(__file__))
     print 'Copying files to local node...'
     commands = []
-    for filename in ['clean.py', 'helper.py', 'manager.py', 'zfs.py']:
+    for filename in ['clean.py', 'compression.py', 'control.py', 'helper.py', 'journal.py', 'manager.py', 'metrics.py', 'scheduler.py', 'zfs.py']:
         commands.append('cp {0}/../scripts/{1} /usr/lib/zfs-snap-manager/{1}'.format(this_directory, filename))
         commands.append('rm -f /usr/lib/zfs-snap-manager/{0}c'.format(filename))
     commands.append('systemctl restart zfs-snap-manager')
@@ -0,0 +1,579 @@
+# Copyright (c) 2014 Kenneth Henderick <kenneth@ketronic.be>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Fake zfs, ssh and mbuffer executables, used by the benchmark suite
+* The state of all simulated hosts is stored in a single json file (FAKE_ZFS_STATE)
+* Every invocation is appended to a log file (FAKE_ZFS_LOG), so call volumes can be counted
+* Only the subset of the zfs command line that is used by the manager is supported
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+from subprocess import call
+
+
+SSH_OPTIONS_WITH_ARGUMENT = 'bcDEeFIiJLlmOopQRSWw'
+CHUNK_SIZE = 128 * 1024
+
+
+class State(object):
+    """
+    Loads and saves the simulated hosts, holding a lock in between
+    """
+
+    def __init__(self):
+        self.filename = os.environ['FAKE_ZFS_STATE']
+        self.lock = open(self.filename + '.lock', 'a')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        with open(self.filename) as state_file:
+            self.data = json.load(state_file)
+        self.host = os.environ.get('FAKE_ZFS_HOST', 'localhost')
+        self.datasets = self.data['hosts'].setdefault(self.host, {})
+        self.config = self.data['config']
+
+    def save(self):
+        with open(self.filename + '.tmp', 'w') as state_file:
+            json.dump(self.data, state_file)
+        os.rename(self.filename + '.tmp', self.filename)
+        self.close()
+
+    def close(self):
+        if self.lock is not None:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+            self.lock.close()
+            self.lock = None
+
+    def next_txg(self):
+        self.data['txg'] += 1
+        return self.data['txg']
+
+    def touch(self, dataset):
+        self.datasets[dataset]['changed'] = self.next_txg()
+
+
+def log(tool, **fields):
+    """
+    Appends an invocation to the log file
+    """
+
+    fields['tool'] = tool
+    fields['host'] = os.environ.get('FAKE_ZFS_HOST', 'localhost')
+    with open(os.environ['FAKE_ZFS_LOG'], 'a') as log_file:
+        fcntl.flock(log_file, fcntl.LOCK_EX)
+        log_file.write(json.dumps(fields) + '\n')
+
+
+def fail(message):
+    sys.stderr.write(message + '\n')
+    sys.exit(1)
+
+
+def split_name(name):
+    if '@' in name:
+        return name.split('@', 1)
+    return name, None
+
+
+def find_snapshot(state, name):
+    dataset, snapshot = split_name(name)
+    if dataset not in state.datasets:
+        fail('cannot open \'{0}\': dataset does not exist'.format(name))
+    for entry in state.datasets[dataset]['snapshots']:
+        if entry['name'] == snapshot:
+            return entry
+    fail('cannot open \'{0}\': dataset does not exist'.format(name))
+
+
+def zfs_list(state, arguments):
+    types = ['filesystem', 'volume']
+    properties = ['name', 'used', 'avail', 'refer', 'mountpoint']
+    depth = None
+    roots = []
+    index = 0
+    while index < len(arguments):
+        argument = arguments[index]
+        if argument == '-t':
+            index += 1
+            types = arguments[index].split(',')
+        elif argument == '-o':
+            index += 1
+            properties = arguments[index].split(',')
+        elif argument == '-d':
+            index += 1
+            depth = int(arguments[index])
+        elif argument in ('-s', '-S'):
+            index += 1
+        elif argument == '-r':
+            depth = depth if depth is not None else 1000
+        elif not argument.startswith('-'):
+            roots.append(argument)
+        index += 1
+    if not roots:
+        roots = sorted(state.datasets.keys())
+        depth = 0
+    failed = False
+    rows = []
+    for root in roots:
+        if root not in state.datasets:
+            sys.stderr.write('cannot open \'{0}\': dataset does not exist\n'.format(root))
+            failed = True
+            continue
+        level = root.count('/')
+        for dataset in sorted(state.datasets):
+            if dataset != root and not dataset.startswith(root + '/'):
+                continue
+            dataset_depth = dataset.count('/') - level
+            if depth is not None and dataset_depth > depth:
+                continue
+            info = state.datasets[dataset]
+            if info['type'] in types:
+                rows.append((info['txg'], dataset, info))
+            if 'snapshot' in types and (depth is None or dataset_depth + 1 <= depth):
+                for entry in info['snapshots']:
+                    rows.append((entry['txg'], '{0}@{1}'.format(dataset, entry['name']), entry))
+            if 'bookmark' in types and (depth is None or dataset_depth + 1 <= depth):
+                for entry in info.get('bookmarks', []):
+                    rows.append((entry['txg'], '{0}#{1}'.format(dataset, entry['name']), entry))
+    rows.sort(key=lambda row: row[0])
+    output = []
+    for txg, name, entry in rows:
+        values = []
+        for prop in properties:
+            if prop == 'name':
+                values.append(name)
+            elif prop == 'createtxg':
+                values.append(str(txg))
+            elif prop == 'userrefs':
+                values.append(str(len(entry.get('holds', []))) if '@' in name else '-')
+            else:
+                values.append('-')
+        output.append('\t'.join(values))
+    if output:
+        sys.stdout.write('\n'.join(output) + '\n')
+    if failed:
+        sys.exit(1)
+
+
+def zfs_get(state, arguments):
+    columns = ['name', 'property', 'value', 'source']
+    positional = []
+    index = 0
+    while index < len(arguments):
+        if arguments[index] == '-o':
+            index += 1
+            columns = arguments[index].split(',')
+        elif not arguments[index].startswith('-'):
+            positional.append(arguments[index])
+        index += 1
+    prop = positional[0]
+    failed = False
+    for name in positional[1:]:
+        if name not in state.datasets:
+            sys.stderr.write('cannot open \'{0}\': dataset does not exist\n'.format(name))
+            failed = True
+            continue
+        info = state.datasets[name]
+        if prop == 'snapshots_changed':
+            if not state.config.get('snapshots_changed', True):
+                fail('bad property list: invalid property \'snapshots_changed\'')
+            value = str(info.get('changed', 0))
+        elif prop == 'receive_resume_token':
+            value = info.get('resume') or '-'
+        else:
+            value = '-'
+        row = {'name': name, 'property': prop, 'value': value, 'source': '-'}
+        sys.stdout.write('\t'.join(row[column] for column in columns) + '\n')
+    if failed:
+        sys.exit(1)
+
+
+def zfs_snapshot(state, arguments):
+    recursive = '-r' in arguments
+    dataset, name = split_name([argument for argument in arguments if not argument.startswith('-')][0])
+    if dataset not in state.datasets:
+        fail('cannot open \'{0}\': dataset does not exist'.format(dataset))
+    for child in sorted(state.datasets):
+        if child == dataset or (recursive and child.startswith(dataset + '/')):
+            if name in [entry['name'] for entry in state.datasets[child]['snapshots']]:
+                fail('cannot create snapshot \'{0}@{1}\': dataset already exists'.format(child, name))
+            state.datasets[child]['snapshots'].append({'name': name, 'txg': state.next_txg(), 'holds': [],
+                                                       'size': state.config.get('snapshot_size', 1048576)})
+            state.touch(child)
+    state.save()
+
+
+def zfs_bookmark(state, arguments):
+    positional = [argument for argument in arguments if not argument.startswith('-')]
+    entry = find_snapshot(state, positional[0])
+    dataset, name = positional[1].split('#', 1)
+    bookmarks = state.datasets[dataset].setdefault('bookmarks', [])
+    if name in [bookmark['name'] for bookmark in bookmarks]:
+        fail('cannot create bookmark \'{0}\': bookmark exists'.format(positional[1]))
+    bookmarks.append({'name': name, 'txg': entry['txg'], 'snapshot': entry['name']})
+    state.save()
+
+
+def find_bookmark(state, name):
+    dataset, bookmark = name.split('#', 1)
+    for entry in state.datasets.get(dataset, {}).get('bookmarks', []):
+        if entry['name'] == bookmark:
+            return entry
+    fail('cannot open \'{0}\': bookmark does not exist'.format(name))
+
+
+def zfs_destroy(state, arguments):
+    recursive = '-r' in arguments
+    name = [argument for argument in arguments if not argument.startswith('-')][0]
+    if '#' in name:
+        entry = find_bookmark(state, name)
+        state.datasets[name.split('#')[0]]['bookmarks'].remove(entry)
+        state.save()
+        return
+    dataset, names = split_name(name)
+    names = names.split(',')
+    if dataset not in state.datasets:
+        fail('cannot open \'{0}\': dataset does not exist'.format(dataset))
+    for child in sorted(state.datasets):
+        if child == dataset or (recursive and child.startswith(dataset + '/')):
+            info = state.datasets[child]
+            for entry in info['snapshots']:
+                if entry['name'] in names and entry.get('holds'):
+                    fail('cannot destroy snapshot {0}@{1}: dataset is busy'.format(child, entry['name']))
+            info['snapshots'] = [entry for entry in info['snapshots'] if entry['name'] not in names]
+            state.touch(child)
+    state.save()
+
+
+def zfs_hold(state, arguments, release=False):
+    positional = [argument for argument in arguments if not argument.startswith('-')]
+    tag = positional[0]
+    names = positional[1:]
+    if '-r' in arguments:
+        names = []
+        for name in positional[1:]:
+            dataset, snapshot = split_name(name)
+            find_snapshot(state, name)
+            for child in sorted(state.datasets):
+                if child == dataset or child.startswith(dataset + '/'):
+                    if snapshot in [entry['name'] for entry in state.datasets[child]['snapshots']]:
+                        names.append('{0}@{1}'.format(child, snapshot))
+    for name in names:
+        entry = find_snapshot(state, name)
+        if release:
+            if tag not in entry['holds']:
+                fail('cannot release hold from snapshot \'{0}\': no such tag on this dataset'.format(name))
+            entry['holds'].remove(tag)
+        else:
+            if tag in entry['holds']:
+                fail('cannot hold snapshot \'{0}\': tag already exists on this dataset'.format(name))
+            entry['holds'].append(tag)
+    state.save()
+
+
+def zfs_holds(state, arguments):
+    failed = False
+    for name in [argument for argument in arguments if not argument.startswith('-')]:
+        dataset, snapshot = split_name(name)
+        entries = [entry for entry in state.datasets.get(dataset, {}).get('snapshots', []) if entry['name'] == snapshot]
+        if not entries:
+            sys.stderr.write('cannot open \'{0}\': dataset does not exist\n'.format(name))
+            failed = True
+            continue
+        for tag in entries[0]['holds']:
+            sys.stdout.write('{0}\t{1}\tThu Jan  1 00:00 1970\n'.format(name, tag))
+    if failed:
+        sys.exit(1)
+
+
+def zfs_send(state, arguments):
+    dry_run = False
+    parsable = False
+    base = None
+    intermediates = False
+    token = None
+    compressed = False
+    replicate = False
+    positional = []
+    index = 0
+    while index < len(arguments):
+        argument = arguments[index]
+        if argument in ('-i', '-I'):
+            intermediates = argument == '-I'
+            index += 1
+            base = arguments[index]
+        elif argument == '-t':
+            index += 1
+            token = arguments[index]
+        elif argument.startswith('-'):
+            dry_run = dry_run or 'n' in argument
+            parsable = parsable or 'P' in argument
+            compressed = compressed or 'c' in argument or 'w' in argument
+            replicate = replicate or 'R' in argument
+        else:
+            positional.append(argument)
+        index += 1
+    if token is not None:
+        token_info = json.loads(token.split('-', 1)[1].decode('hex'))
+        dataset, last = split_name(token_info['toname'])
+        base = token_info['fromname']
+        skip = token_info['bytes']
+        compressed = token_info.get('compressok', False)
+    else:
+        dataset, last = split_name(positional[0])
+        skip = 0
+    if dataset not in state.datasets:
+        fail('cannot open \'{0}\': dataset does not exist'.format(dataset))
+    snapshots = state.datasets[dataset]['snapshots']
+    names = [entry['name'] for entry in snapshots]
+    if last not in names:
+        fail('cannot open \'{0}@{1}\': dataset does not exist'.format(dataset, last))
+    end = names.index(last)
+    if base is None:
+        start = 0
+        base_name = None
+        sent = [snapshots[end]]
+        size = sum(entry['size'] for entry in snapshots[:end + 1])
+    elif '#' in base:
+        # The incremental source is a bookmark, of which the snapshot might be destroyed already
+        bookmark = find_bookmark(state, base if base.startswith(dataset) else dataset + base)
+        base_name = bookmark['snapshot']
+        start = len([entry for entry in snapshots if entry['txg'] <= bookmark['txg']])
+        sent = snapshots[start:end + 1] if intermediates else [snapshots[end]]
+        size = sum(entry['size'] for entry in snapshots[start:end + 1])
+    else:
+        base_name = base.split('@')[-1]
+        if base_name not in names:
+            fail('cannot open \'{0}\': dataset does not exist'.format(base))
+        start = names.index(base_name) + 1
+        sent = snapshots[start:end + 1] if intermediates else [snapshots[end]]
+        size = sum(entry['size'] for entry in snapshots[start:end + 1])
+    ratio = float(state.config.get('compressratio', 1)) if compressed else 1.0
+    if token is None and (intermediates or (replicate and base is None)):
+        estimates = [(dataset, entry['name'], int(entry['size'] / ratio)) for entry in (snapshots[:end + 1] if base is None else sent)]
+    else:
+        estimates = [(dataset, last, int(size / ratio) - skip)]
+    if replicate:
+        if base is None:
+            sent = snapshots[:end + 1]
+        children = []
+        for child in sorted(state.datasets):
+            if not child.startswith(dataset + '/'):
+                continue
+            child_snapshots = state.datasets[child]['snapshots']
+            child_names = [entry['name'] for entry in child_snapshots]
+            if last not in child_names:
+                continue
+            child_end = child_names.index(last)
+            child_start = child_names.index(base_name) + 1 if base_name in child_names else 0
+            child_sent = child_snapshots[child_start:child_end + 1]
+            children.append({'suffix': child[len(dataset):], 'base': base_name if child_start > 0 else None,
+                             'snapshots': [dict(entry, holds=[]) for entry in child_sent]})
+            size += sum(entry['size'] for entry in child_sent)
+            estimates.extend((child, entry['name'], int(entry['size'] / ratio)) for entry in child_sent)
+    if compressed:
+        size = int(size / float(state.config.get('compressratio', 1)))
+    state.close()
+    if dry_run:
+        log('zfs', args=arguments, kind='send-dry-run')
+        if token is not None:
+            sys.stderr.write('resume token contents:\nnvlist version: 0\n\ttoname = {0}@{1}\n\tbytes = {2}\n'.format(dataset, last, skip))
+        if parsable:
+            previous = {}
+            for name, snapshot, estimate in estimates:
+                if name not in previous and base_name is not None and (name == dataset or base_name in
+                                                                        [entry['name'] for entry in state.datasets[name]['snapshots']]):
+                    previous[name] = base_name
+                if name in previous:
+                    sys.stderr.write('incremental\t{0}\t{1}@{2}\t{3}\n'.format(previous[name], name, snapshot, estimate))
+                else:
+                    sys.stderr.write('full\t{0}@{1}\t{2}\n'.format(name, snapshot, estimate))
+                previous[name] = snapshot
+            sys.stderr.write('size\t{0}\n'.format(size - skip))
+        else:
+            sys.stderr.write('total estimated size is {0}\n'.format(size - skip))
+        return
+    header = {'dataset': dataset, 'base': base_name, 'snapshots': [dict(entry, holds=[]) for entry in sent],
+              'size': size, 'skip': skip, 'compressed': compressed, 'children': children if replicate else []}
+    sys.stdout.write(json.dumps(header) + '\n')
+    throughput = float(state.config.get('throughput', 0))
+    remaining = size - skip
+    started = time.time()
+    written = 0
+    block = '\0' * CHUNK_SIZE
+    while remaining > 0:
+        length = min(remaining, CHUNK_SIZE)
+        sys.stdout.write(block[:length])
+        remaining -= length
+        written += length
+        if throughput > 0:
+            delay = written / throughput - (time.time() - started)
+            if delay > 0:
+                time.sleep(delay)
+    sys.stdout.flush()
+    log('zfs', args=arguments, kind='send', bytes=written)
+
+
+def zfs_receive(state, arguments):
+    positional = [argument for argument in arguments if not argument.startswith('-')]
+    target = positional[0]
+    if '-A' in arguments:
+        if target in state.datasets:
+            state.datasets[target]['resume'] = None
+        state.save()
+        return
+    state.close()
+    header = json.loads(sys.stdin.readline())
+    received = 0
+    while True:
+        data = sys.stdin.read(CHUNK_SIZE)
+        if not data:
+            break
+        received += len(data)
+    if received + header['skip'] < header['size']:
+        if '-s' in arguments:
+            state = State()
+            info = state.datasets.setdefault(target, {'type': 'filesystem', 'txg': state.next_txg(), 'snapshots': []})
+            token = {'toname': '{0}@{1}'.format(header['dataset'], header['snapshots'][0]['name']),
+                     'fromname': header['base'], 'bytes': received + header['skip'], 'compressok': header['compressed']}
+            info['resume'] = '1-' + json.dumps(token).encode('hex')
+            state.save()
+        fail('cannot receive incremental stream: checksum mismatch or incomplete stream')
+    state = State()
+    streams = [dict(header, suffix='')] + header.get('children', [])
+    for stream in streams:
+        receive_stream(state, target + stream['suffix'], stream, '-F' in arguments)
+    state.save()
+    log('zfs', args=arguments, kind='receive', bytes=received)
+
+
+def receive_stream(state, target, stream, force):
+    info = state.datasets.get(target)
+    if stream['base'] is None:
+        if info is not None and info['snapshots'] and not force:
+            fail('cannot receive new filesystem stream: destination \'{0}\' exists'.format(target))
+        info = {'type': 'filesystem', 'txg': state.next_txg(), 'snapshots': []}
+        state.datasets[target] = info
+    else:
+        if info is None or not info['snapshots']:
+            fail('cannot receive incremental stream: destination \'{0}\' does not exist'.format(target))
+        names = [entry['name'] for entry in info['snapshots']]
+        if stream['base'] not in names:
+            fail('cannot receive incremental stream: most recent snapshot of {0} does not match incremental source'.format(target))
+        if names[-1] != stream['base']:
+            if not force:
+                fail('cannot receive incremental stream: destination {0} has been modified'.format(target))
+            info['snapshots'] = info['snapshots'][:names.index(stream['base']) + 1]
+    for entry in stream['snapshots']:
+        info['snapshots'].append(dict(entry, txg=state.next_txg(), holds=[]))
+    info['resume'] = None
+    state.touch(target)
+
+
+def zfs(arguments):
+    latency = float(os.environ.get('FAKE_ZFS_LATENCY', '0'))
+    if latency > 0:
+        time.sleep(latency)
+    if not arguments:
+        fail('missing command')
+    command = arguments[0]
+    if command not in ('send', 'receive', 'recv'):
+        log('zfs', args=arguments)
+    state = State()
+    handlers = {'list': zfs_list, 'get': zfs_get, 'snapshot': zfs_snapshot, 'destroy': zfs_destroy, 'bookmark': zfs_bookmark,
+                'hold': zfs_hold, 'release': lambda s, a: zfs_hold(s, a, release=True), 'holds': zfs_holds,
+                'send': zfs_send, 'receive': zfs_receive, 'recv': zfs_receive}
+    if command not in handlers:
+        fail('unsupported command: {0}'.format(command))
+    try:
+        handlers[command](state, arguments[1:])
+    finally:
+        state.close()
+
+
+def ssh(arguments):
+    options = {}
+    index = 0
+    while index < len(arguments) and arguments[index].startswith('-'):
+        argument = arguments[index]
+        if argument[1:2] in SSH_OPTIONS_WITH_ARGUMENT and len(argument) == 2:
+            index += 1
+            if argument == '-o':
+                key, _, value = arguments[index].partition('=')
+                options[key] = value
+        index += 1
+    host = arguments[index]
+    command = ' '.join(arguments[index + 1:])
+    control_path = options.get('ControlPath')
+    new_session = True
+    if control_path is not None and options.get('ControlMaster') in ('auto', 'yes'):
+        control_path = control_path.replace('%C', hashlib.sha1(host).hexdigest())
+        if os.path.exists(control_path):
+            new_session = False
+        else:
+            open(control_path, 'w').close()
+    log('ssh', target=host, new_session=new_session)
+    if new_session:
+        latency = float(os.environ.get('FAKE_SSH_LATENCY', '0'))
+        if latency > 0:
+            time.sleep(latency)
+    environment = dict(os.environ)
+    environment['FAKE_ZFS_HOST'] = host
+    sys.exit(call(command, shell=True, env=environment))
+
+
+def mbuffer(arguments):
+    host = os.environ.get('FAKE_ZFS_HOST', 'localhost')
+    with open(os.environ['FAKE_ZFS_STATE']) as state_file:
+        if host in json.load(state_file)['config'].get('stalled_hosts', []):
+            # Simulates a peer that went away without closing the connection
+            while True:
+                time.sleep(60)
+    outputs = [sys.stdout]
+    filenames = [arguments[index + 1] for index, argument in enumerate(arguments) if argument == '-o']
+    if filenames:
+        # Like mbuffer, an output that fails is disabled while writing to the other ones continues
+        outputs = [open(filename, 'w') for filename in filenames]
+    transferred = 0
+    while True:
+        data = sys.stdin.read(CHUNK_SIZE)
+        if not data:
+            break
+        for output in list(outputs):
+            try:
+                output.write(data)
+            except IOError:
+                outputs.remove(output)
+        transferred += len(data)
+    for output in outputs:
+        try:
+            output.close() if output is not sys.stdout else output.flush()
+        except IOError:
+            pass
+    log('mbuffer', bytes=transferred)
+
+
+if __name__ == '__main__':
+    tool = os.path.basename(sys.argv[1])
+    {'zfs': zfs, 'ssh': ssh, 'mbuffer': mbuffer}[tool](sys.argv[2:])
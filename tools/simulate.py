@@ -0,0 +1,186 @@
+# Copyright (c) 2014 Kenneth Henderick <kenneth@ketronic.be>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Simulates the snapshot retention of the configured sections over a virtual clock, without touching ZFS
+* Every simulated day, the manager decides which sections are due and the cleaner applies their schema
+* The snapshots start empty, or from a dump of `zfs list -H -t snapshot -o name`
+* Reports per day the snapshot count, the retained ages and the destroy batch sizes
+* Datasets sharing their schema, schedule and snapshots (e.g. snapshotted by the same daemon) are simulated once,
+  so thousands of datasets take seconds
+"""
+
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+
+this_directory = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(this_directory, '..', 'scripts'))
+
+from manager import Manager
+from clean import Cleaner
+
+
+def snapshot_name(day):
+    return '{0:04d}{1:02d}{2:02d}'.format(day.year, day.month, day.day)
+
+
+def load_dump(filename):
+    """
+    Reads the snapshots per dataset from a `zfs list` dump, in the listed order
+    """
+
+    snapshots = {}
+    with (sys.stdin if filename == '-' else open(filename)) as dump_file:
+        for line in dump_file:
+            name = line.split('\t')[0].strip()
+            if '@' in name:
+                dataset, snapshot = name.split('@', 1)
+                snapshots.setdefault(dataset, []).append(snapshot)
+    return snapshots
+
+
+def build_groups(settings, snapshots):
+    """
+    Groups the datasets that share their schema, schedule and snapshots
+    """
+
+    groups = {}
+    for dataset in sorted(settings):
+        dataset_settings = settings[dataset]
+        # Pulled sections receive the source's snapshots, assumed to follow the same schedule
+        takes_snapshots = dataset_settings['snapshot'] is True or dataset_settings['replicate'] is not None
+        key = (dataset_settings['schema'], dataset_settings['time'] if takes_snapshots else None, tuple(snapshots.get(dataset, [])))
+        group = groups.setdefault(key, {'datasets': [], 'settings': dataset_settings, 'snapshots': list(key[2])})
+        group['datasets'].append(dataset)
+    return groups
+
+
+def simulate_day(groups, now, day_index, trigger_interval, dataset=None):
+    """
+    Takes the day's snapshots and cleans, as the manager's run at the given time would. Returns the new groups,
+    the number of destroyed snapshots, the largest destroy batch of a dataset and the batch of the given dataset.
+    """
+
+    today = snapshot_name(now)
+    yesterday = snapshot_name(now - timedelta(1))
+    new_groups = {}
+    destroyed = 0
+    largest_batch = 0
+    batch = None
+    for key, group in groups.items():
+        schema, schedule, _ = key
+        snapshots = group['snapshots']
+        if schedule == 'trigger':
+            due = day_index % trigger_interval == 0
+        elif schedule is not None:
+            due = Manager.is_due(group['datasets'][0], group['settings'], snapshots, now)
+        else:
+            due = False
+        if due is True and today not in snapshots:
+            snapshots = snapshots + [today]
+        delete = []
+        if today in snapshots or yesterday in snapshots:
+            _, delete, _ = Cleaner.plan(snapshots, schema, now)
+            if delete:
+                deleted = set(delete)
+                snapshots = [snapshot for snapshot in snapshots if snapshot not in deleted]
+        new_key = (schema, schedule, tuple(snapshots))
+        if new_key in new_groups:  # Converged with another group
+            new_groups[new_key]['datasets'].extend(group['datasets'])
+        else:
+            new_groups[new_key] = {'datasets': group['datasets'], 'settings': group['settings'], 'snapshots': snapshots}
+        destroyed += len(delete) * len(group['datasets'])
+        largest_batch = max(largest_batch, len(delete))
+        if dataset in group['datasets']:
+            batch = len(delete)
+    return new_groups, destroyed, largest_batch, batch
+
+
+def get_ages(snapshots, now):
+    """
+    Returns the ages in days of the snapshots following the naming convention, oldest first
+    """
+
+    today = now.toordinal()
+    ordinals = [Cleaner.ordinals.get(snapshot) or Cleaner.parse_name(snapshot) for snapshot in snapshots]
+    return sorted((today - ordinal for ordinal in ordinals if ordinal is not None), reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulates the snapshot retention of the configured sections')
+    parser.add_argument('--config', default='/etc/zfssnapmanager.cfg', help='Configuration file')
+    parser.add_argument('--snapshots', help='Dump of `zfs list -H -t snapshot -o name` to start from, - for stdin')
+    parser.add_argument('--schema', help='Schema to simulate instead of the configured ones')
+    parser.add_argument('--start', help='First simulated day, as yyyymmdd (default: today)')
+    parser.add_argument('--days', type=int, default=5 * 365, help='Number of simulated days')
+    parser.add_argument('--trigger-interval', type=int, default=1, help='Days between two triggers of trigger-based sections')
+    parser.add_argument('--dataset', help='Show the retained ages of a single dataset')
+    options = parser.parse_args()
+
+    logger = logging.getLogger('simulate')
+    logger.addHandler(logging.NullHandler())
+    Manager.logger = logger
+    Cleaner.logger = logger
+
+    settings, _ = Manager.load_config(options.config)
+    snapshots = load_dump(options.snapshots) if options.snapshots else {}
+    if not settings:
+        # Without configuration, the dumped datasets get a daily snapshot
+        if options.schema is None:
+            parser.error('--schema is required without configured sections')
+        settings = dict((dataset, {'time': '00:00', 'snapshot': True, 'replicate': None, 'schema': options.schema})
+                        for dataset in snapshots)
+    if options.schema is not None:
+        Cleaner.compile_schema(options.schema)
+        for dataset in settings:
+            settings[dataset]['schema'] = options.schema
+    if options.dataset is not None and options.dataset not in settings:
+        parser.error('Unknown section {0}'.format(options.dataset))
+    start = datetime.strptime(options.start, '%Y%m%d') if options.start else datetime.now()
+    start = start.replace(hour=23, minute=59, second=0, microsecond=0)  # After the time of every section
+
+    groups = build_groups(settings, snapshots)
+    if options.dataset is not None:
+        print 'date\tsnapshots\tdestroyed\tages'
+    else:
+        print 'date\tdatasets\tsnapshots\tdestroyed\tlargest_batch\toldest'
+    for day_index in range(options.days):
+        now = start + timedelta(day_index)
+        groups, destroyed, largest_batch, batch = simulate_day(groups, now, day_index, options.trigger_interval, options.dataset)
+        if options.dataset is not None:
+            group = [group for group in groups.values() if options.dataset in group['datasets']][0]
+            print '{0}\t{1}\t{2}\t{3}'.format(snapshot_name(now), len(group['snapshots']), batch,
+                                              ','.join(str(age) for age in get_ages(group['snapshots'], now)))
+            continue
+        count = 0
+        oldest = 0
+        for group in groups.values():
+            count += len(group['snapshots']) * len(group['datasets'])
+            ages = get_ages(group['snapshots'], now)
+            if ages:
+                oldest = max(oldest, ages[0])
+        print '{0}\t{1}\t{2}\t{3}\t{4}\t{5}'.format(snapshot_name(now), len(settings), count, destroyed, largest_batch, oldest)
+
+
+if __name__ == '__main__':
+    main()